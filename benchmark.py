@@ -0,0 +1,206 @@
+"""
+Benchmark training throughput, peak memory and dev F1 of model variants, e.g.
+
+    python benchmark.py --steps 200 precision --precisions fp32 bf16
+    python benchmark.py nas --batch_size 50
+
+Every training variant is trained from the same seed in a fresh process, so that peak
+memory is measured per variant.
+"""
+
+import time
+import random
+import resource
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+
+from data.loader import DataLoader
+from model.rnn import RelationModel
+from model.blocks import NASRNN
+from utils import scorer, constant
+from utils.helper import iter_json
+from utils.config import default_config_path, load_model_config
+from utils.vocab import Vocab, vocab_file as vocab_path
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark model variants.')
+    parser.add_argument('--config', type=str, default='', help='Model config yaml; defaults to the one train.py uses.')
+    parser.add_argument('--steps', type=int, default=200, help='Training steps per variant.')
+    parser.add_argument('--warmup', type=int, default=10, help='Initial steps excluded from timing.')
+    parser.add_argument('--threads', type=int, default=0, help='Torch intra-op threads; 0 keeps the default.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    precision_parser = subparsers.add_parser('precision', help='Compare autocast precisions.')
+    precision_parser.add_argument('--precisions', type=str, nargs='+', default=['fp32', 'bf16'],
+                                  help='Precisions to compare (fp32, bf16, fp16).')
+
+    nas_parser = subparsers.add_parser('nas', help='Compare NASRNN recurrence implementations.')
+    nas_parser.add_argument('--batch_size', type=int, default=50)
+    nas_parser.add_argument('--num_batches', type=int, default=20, help='Batches timed per implementation.')
+    nas_parser.add_argument('--input_dim', type=int, default=360, help='Word, POS and NER embedding size.')
+    nas_parser.add_argument('--hidden_dim', type=int, default=200)
+    nas_parser.add_argument('--length_file', type=str, default='',
+                            help='Sample sentence lengths from this dataset file instead of a TACRED-like distribution.')
+    nas_parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args()
+    return args
+
+def load_opt(config_path, overrides):
+    opt = load_model_config(config_path if len(config_path) > 0 else default_config_path())
+    opt['cuda'] = torch.cuda.is_available()
+    opt['cpu'] = not opt['cuda']
+    opt['num_class'] = len(constant.LABEL_TO_ID)
+    opt.update(overrides)
+    return opt
+
+def train_batches(data_batch):
+    """ Cycle over the batches of data_batch indefinitely. """
+    while True:
+        for batch in data_batch:
+            yield batch
+
+def peak_memory_mb(opt):
+    if opt['cuda']:
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+def benchmark_training(config_path, overrides, steps, warmup, threads):
+    """ Train a variant for steps steps and evaluate it on dev. Returns its metrics as a dict. """
+    if threads > 0:
+        torch.set_num_threads(threads)
+    opt = load_opt(config_path, overrides)
+    torch.manual_seed(opt['seed'])
+    np.random.seed(opt['seed'])
+    random.seed(opt['seed'])
+
+    vocab = Vocab(vocab_path(opt['vocab_dir']), load=True)
+    opt['vocab_size'] = vocab.size
+    opt['subj_idxs'] = vocab.subj_idxs
+    opt['obj_idxs'] = vocab.obj_idxs
+    emb_matrix = np.load(opt['vocab_dir'] + '/embedding.npy', mmap_mode='r')
+    train_batch = DataLoader(opt['data_dir'] + '/train.json', opt['batch_size'], opt, vocab, evaluation=False)
+    dev_batch = DataLoader(opt['data_dir'] + '/dev.json', opt['batch_size'], opt, vocab, evaluation=True)
+    model = RelationModel(opt, emb_matrix=emb_matrix)
+    del emb_matrix
+
+    batches = train_batches(train_batch)
+    train_loss = 0
+    for step in range(steps):
+        if step == warmup:
+            if opt['cuda']:
+                torch.cuda.synchronize()
+            start_time = time.time()
+        train_loss += model.update(next(batches))
+    if opt['cuda']:
+        torch.cuda.synchronize()
+    steps_per_sec = (steps - warmup) / (time.time() - start_time)
+
+    predictions = []
+    for batch in dev_batch:
+        preds, _ = model.infer(batch)
+        predictions += preds.tolist()
+    _, _, dev_f1 = scorer.score_ids(dev_batch.gold_ids(), predictions, constant.ID_TO_LABEL)
+    return {'steps/sec': steps_per_sec, 'peak MB': peak_memory_mb(opt),
+            'train loss': train_loss / steps, 'dev F1': dev_f1}
+
+def sample_lengths(length_file, num_lengths, rng):
+    """ Sentence lengths from length_file, or from a normal approximation of TACRED lengths. """
+    if len(length_file) > 0:
+        lengths = np.array([len(d['token']) for d in iter_json(length_file)])
+        return rng.choice(lengths, num_lengths)
+    lengths = rng.normal(36, 14, num_lengths).round().astype(np.int64)
+    return np.clip(lengths, 5, constant.MAX_LEN)
+
+def reference_nasrnn(rnn, inputs, hidden, masks):
+    """ The original NASRNN loop: input projection per step, stacked outputs, masks multiplied in. """
+    outputs = []
+    length = inputs.size()[1]
+    for t in range(length):
+        hidden = rnn.rnn(inputs=inputs[:, t, :], hidden=hidden)
+        outputs.append(hidden)
+    outputs = torch.stack(outputs, 1)
+    outputs *= masks.view(-1, length, 1)
+    return outputs
+
+def time_recurrence(fn, batches, hidden_dim, warmup):
+    """ Time forward and backward passes of fn over batches. Returns the metrics and outputs. """
+    outputs = []
+    for i, (inputs, masks) in enumerate(batches[:warmup] + batches):
+        if i == warmup:
+            start_time = time.time()
+        hidden = torch.zeros(inputs.size(0), hidden_dim)
+        output = fn(inputs, hidden, masks)
+        output.sum().backward()
+        if i >= warmup:
+            outputs.append(output.detach())
+    duration = time.time() - start_time
+    num_tokens = sum(float(masks.sum()) for _, masks in batches)
+    return {'batches/sec': len(batches) / duration, 'tokens/sec': num_tokens / duration}, outputs
+
+def benchmark_nas(args):
+    rng = np.random.RandomState(args.seed)
+    torch.manual_seed(args.seed)
+    lengths = sample_lengths(args.length_file, args.batch_size * args.num_batches, rng)
+    batches = []
+    for start in range(0, len(lengths), args.batch_size):
+        # sorted by decreasing length, like DataLoader batches
+        batch_lengths = torch.from_numpy(np.sort(lengths[start: start + args.batch_size])[::-1].copy())
+        max_len = int(batch_lengths[0])
+        inputs = torch.randn(len(batch_lengths), max_len, args.input_dim)
+        masks = (torch.arange(max_len).view(1, -1) < batch_lengths.view(-1, 1)).float()
+        batches.append((inputs, masks))
+
+    rnn = NASRNN(args.input_dim, args.hidden_dim, packed=False)
+    packed_rnn = NASRNN(args.input_dim, args.hidden_dim, packed=True)
+    packed_rnn.load_state_dict(rnn.state_dict())
+    variants = [('loop', lambda inputs, hidden, masks: reference_nasrnn(rnn, inputs, hidden, masks)),
+                ('hoisted', rnn), ('packed', packed_rnn)]
+
+    names, results = [], []
+    for name, fn in variants:
+        print("Benchmarking {}...".format(name))
+        result, outputs = time_recurrence(fn, batches, args.hidden_dim, min(args.warmup, len(batches)))
+        if len(results) == 0:
+            reference_outputs = outputs
+        result['max diff'] = max(float((o - r).abs().max()) for o, r in zip(outputs, reference_outputs))
+        names.append(name)
+        results.append(result)
+    print_table(names, results, baseline=results[0], speed_key='batches/sec')
+
+def run_isolated(fn, *args):
+    """ Run fn(*args) in a fresh process. """
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(fn, args)
+
+def print_table(names, results, baseline, speed_key='steps/sec'):
+    columns = list(results[0].keys())
+    print('{:<16}'.format('variant') + ''.join('{:>14}'.format(c) for c in columns) + '{:>10}'.format('speedup'))
+    for name, result in zip(names, results):
+        row = '{:<16}'.format(name) + ''.join('{:>14.4g}'.format(result[c]) for c in columns)
+        print(row + '{:>10.2f}'.format(result[speed_key] / baseline[speed_key]))
+
+def main():
+    args = parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    if args.command == 'nas':
+        benchmark_nas(args)
+        return
+    elif args.command == 'precision':
+        names = args.precisions
+        variants = [{'precision': precision} for precision in args.precisions]
+    assert args.steps > args.warmup, "Need more steps than warmup steps."
+
+    results = []
+    for name, overrides in zip(names, variants):
+        print("Benchmarking {}...".format(name))
+        results.append(run_isolated(benchmark_training, args.config, overrides,
+                                    args.steps, args.warmup, args.threads))
+    print_table(names, results, baseline=results[0])
+
+if __name__ == '__main__':
+    main()
@@ -2,19 +2,124 @@
 Data loader for TACRED json files.
 """
 
+import os
 import json
 import random
+import shutil
+import hashlib
 import torch
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from utils import constant, helper, vocab
-from collections import defaultdict
+from utils.helper import iter_json
+
+# bump whenever the preprocessed format changes so that stale caches are ignored
+CACHE_VERSION = 2
+# token level fields, stored as one flat buffer each
+BASE_FIELDS = ('tokens', 'pos', 'ner', 'deprel', 'subj_positions', 'obj_positions')
+
+class PreprocessedData(object):
+    """
+    Columnar storage of preprocessed examples. Every token level field is a single flat
+    int32 buffer over all examples, delimited by one shared offsets array, so shuffling
+    and batching only ever manipulate index arrays.
+    """
+    def __init__(self, fields, offsets, relations, entity_spans):
+        self.fields = fields
+        self.offsets = offsets
+        self.relations = relations
+        # (subj_start, subj_end, obj_start, obj_end) per example
+        self.entity_spans = entity_spans
+
+    @classmethod
+    def from_examples(cls, examples):
+        """ Build from an iterable of dicts returned by DataLoader.preprocess_example. """
+        buffers = dict((name, []) for name in BASE_FIELDS)
+        lengths, relations, entity_spans = [], [], []
+        for example in examples:
+            for name in BASE_FIELDS:
+                buffers[name] += example[name]
+            lengths.append(len(example['tokens']))
+            relations.append(example['relation'])
+            entity_spans.append(example['entity_span'])
+        fields = dict((name, np.array(buffer, dtype=np.int32)) for name, buffer in buffers.items())
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        relations = np.array(relations, dtype=np.int32)
+        entity_spans = np.array(entity_spans, dtype=np.int32).reshape(-1, 4)
+        return cls(fields, offsets, relations, entity_spans)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.relations)
+
+    def arrays(self):
+        arrays = dict(self.fields)
+        arrays.update({'offsets': self.offsets, 'relations': self.relations,
+                       'entity_spans': self.entity_spans})
+        return arrays
+
+    def save(self, dirname):
+        """ Save every array as its own .npy file in dirname. """
+        # write to a temporary directory first so concurrent jobs never read a partial cache
+        tmp_dir = '{}.{}.tmp'.format(dirname, os.getpid())
+        helper.ensure_dir(tmp_dir, verbose=False)
+        for name, array in self.arrays().items():
+            np.save(os.path.join(tmp_dir, name + '.npy'), array)
+        try:
+            os.rename(tmp_dir, dirname)
+        except OSError:
+            # another job finished writing the same cache first
+            shutil.rmtree(tmp_dir)
+
+    @classmethod
+    def load(cls, dirname, mmap_mode=None):
+        arrays = dict((name, np.load(os.path.join(dirname, name + '.npy'), mmap_mode=mmap_mode))
+                      for name in BASE_FIELDS + ('offsets', 'relations', 'entity_spans'))
+        fields = dict((name, arrays.pop(name)) for name in BASE_FIELDS)
+        return cls(fields, **arrays)
 
 class DataLoader(object):
     """
     Load data from json files, preprocess and prepare batches.
     """
     def __init__(self, filename, batch_size, opt, vocab, evaluation=False):
+        self.init_options(batch_size, opt, vocab, evaluation)
+
+        dataset = self.load_cache(filename)
+        if dataset is None:
+            with open(filename) as infile:
+                data = json.load(infile)
+            dataset = self.preprocess(data, vocab, opt)
+            self.save_cache(filename, dataset)
+        self.dataset = dataset
+        indices = np.arange(len(dataset))
+        # shuffle for training
+        if not evaluation:
+            indices = self.shuffle_data(indices)
+
+        # chunk into batches
+        data = self.create_batches(indices=indices, batch_size=batch_size)
+        if self.world_size > 1:
+            data = [self.shard(batch) for batch in data if len(batch) >= self.world_size]
+        self.data = data
+        # gold labels follow the batch order, which length bucketing rearranges
+        if len(data) > 0:
+            indices = np.concatenate(data)
+        else:
+            # e.g. a rank left without examples
+            indices = np.zeros(0, dtype=np.int64)
+
+        self.label_ids = dataset.relations[indices]
+        self.num_examples = len(indices)
+        print("{} batches created for {}".format(len(data), filename))
+
+    def init_options(self, batch_size, opt, vocab, evaluation):
         self.batch_size = batch_size
         self.opt = opt
         self.vocab = vocab
@@ -25,148 +130,172 @@ class DataLoader(object):
         fact_checking_reg = reg_params is not None and reg_params['type'] == 'fact_checking'
         fact_checking_component = opt['fact_checking_attn'] or fact_checking_reg
         self.fact_checking_component = fact_checking_component
+        # number of batches prepared ahead by background threads; 0 builds them synchronously
+        self.prefetch_depth = opt.get('prefetch_depth', 0)
+        self.prefetch_workers = opt.get('prefetch_workers', 1)
+        self.pin_memory = opt['cuda']
+        # distributed training: every rank trains on its own share of each batch
+        self.rank = opt.get('rank', 0)
+        self.world_size = 1 if evaluation else opt.get('world_size', 1)
+
+    def cache_file(self, filename):
+        """ Path of the preprocessed cache for filename, or None if caching is disabled. """
+        cache_dir = self.opt.get('cache_dir', None)
+        if cache_dir is None or cache_dir == 'None':
+            return None
+        key = {
+            'version': CACHE_VERSION,
+            'data': file_digest(filename),
+            'vocab': file_digest(self.vocab.filename),
+            'lower': self.opt['lower'],
+            'remove_entity_types': self.remove_entity_types
+        }
+        key = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf8')).hexdigest()
+        name = os.path.splitext(os.path.basename(filename))[0]
+        return os.path.join(cache_dir, '{}-{}'.format(name, key))
+
+    def load_cache(self, filename):
+        cache_file = self.cache_file(filename)
+        if cache_file is None or not os.path.isdir(cache_file):
+            return None
+        # memory-mapped caches are shared by every process reading them through the page cache
+        dataset = PreprocessedData.load(cache_file, mmap_mode='r' if self.opt.get('cache_mmap', False) else None)
+        print("Preprocessed data loaded from cache {}".format(cache_file))
+        return dataset
+
+    def save_cache(self, filename, dataset):
+        cache_file = self.cache_file(filename)
+        if cache_file is None:
+            return
+        helper.ensure_dir(os.path.dirname(cache_file), verbose=False)
+        dataset.save(cache_file)
+        print("Preprocessed data cached to {}".format(cache_file))
+
+    def create_batches(self, indices, batch_size):
+        batching = self.opt.get('batching', 'sequential')
+        # evaluation outputs have to follow the order of the data file
+        if self.eval or batching == 'sequential':
+            return [indices[batch_start: batch_start + batch_size]
+                    for batch_start in range(0, len(indices), batch_size)]
+
+        # sort pools of consecutive (shuffled) examples by length, so that every batch
+        # holds sentences of similar lengths and little padding
+        offsets = self.dataset.offsets
+        lengths = offsets[indices + 1] - offsets[indices]
+        pool_size = self.opt.get('bucket_pool', 100) * batch_size
+        batched_data = []
+        for pool_start in range(0, len(indices), pool_size):
+            pool_end = pool_start + pool_size
+            order = np.argsort(lengths[pool_start: pool_end], kind='stable')
+            pool = indices[pool_start: pool_end][order]
+            if batching == 'bucket':
+                batched_data += [pool[batch_start: batch_start + batch_size]
+                                 for batch_start in range(0, len(pool), batch_size)]
+            elif batching == 'token_budget':
+                pool_lengths = lengths[pool_start: pool_end][order]
+                batched_data += split_by_token_budget(pool, pool_lengths, self.opt['max_tokens'])
+            else:
+                raise ValueError("Unsupported batching: {}".format(batching))
+        # shuffle bucket order
+        return [batched_data[i] for i in np.random.permutation(len(batched_data))]
 
-        with open(filename) as infile:
-            data = json.load(infile)
-        data = self.preprocess(data, vocab, opt)
-        # shuffle for training
-        if not evaluation:
-            data = self.shuffle_data(data)
+    def shard(self, batch):
+        """ This rank's share of batch. Striding keeps the shares of length sorted batches alike. """
+        return batch[self.rank::self.world_size]
 
-        id2label = dict([(v,k) for k,v in constant.LABEL_TO_ID.items()])
-        self.labels = [id2label[d[-1]] for d in data['base']]
-        self.num_examples = len(data['base'])
-        # chunk into batches
-        data = self.create_batches(data=data, batch_size=batch_size)
-        self.data = data
-        print("{} batches created for {}".format(len(data), filename))
-
-    def create_batches(self, data, batch_size):
-        batched_data = []
-        for batch_start in range(0, len(data['base']), batch_size):
-
-            batch_end = batch_start + batch_size
-            base_batch = data['base'][batch_start: batch_end]
-            data_batch = {'base': base_batch, 'supplemental': dict()}
-            supplemental_batch = data_batch['supplemental']
-            for component in data['supplemental']:
-                supplemental_batch[component] = data['supplemental'][component][batch_start: batch_end]
-            batched_data.append(data_batch)
-        return batched_data
-
-    def shuffle_data(self, data):
-        indices = list(range(len(data['base'])))
-        random.shuffle(indices)
-        shuffled_base = data['base'][indices]
-        supplemental_data = data['supplemental']
-        for name, component in supplemental_data.items():
-            supplemental_data[name] = component[indices]
-        shuffled_data = {'base': shuffled_base, 'supplemental': supplemental_data}
-        return shuffled_data
-
-    def add_entity_mask(self, length, span):
-        mask = np.ones(length, dtype=np.float32) * constant.PAD_ID
-        mask[span[0]: span[1] + 1] = 1.
-        return mask
-
-    def add_entity_masks(self, length, subj_span, obj_span):
-        subj_mask = self.add_entity_mask(length=length, span=subj_span)
-        obj_mask = self.add_entity_mask(length=length, span=obj_span)
-        return (subj_mask, obj_mask)
+    def shuffle_data(self, indices):
+        return indices[np.random.permutation(len(indices))]
 
     def preprocess(self, data, vocab, opt):
         """ Preprocess the data and convert to ids. """
-        base_processed = []
-        supplemental_components = defaultdict(list)
-        for d in data:
-            tokens = d['token']
-            if opt['lower']:
-                tokens = [t.lower() for t in tokens]
-            # anonymize tokens
-            ss, se = d['subj_start'], d['subj_end']
-            os, oe = d['obj_start'], d['obj_end']
-            if self.remove_entity_types:
-                tokens[ss:se + 1] = ['SUBJ'] * (se - ss + 1)
-                tokens[os:oe + 1] = ['OBJ'] * (oe - os + 1)
-            else:
-                tokens[ss:se+1] = ['SUBJ-'+d['subj_type']] * (se-ss+1)
-                tokens[os:oe+1] = ['OBJ-'+d['obj_type']] * (oe-os+1)
-
-            tokens = map_to_ids(tokens, vocab.word2id)
-            pos = map_to_ids(d['stanford_pos'], constant.POS_TO_ID)
-            ner = map_to_ids(d['stanford_ner'], constant.NER_TO_ID)
-            deprel = map_to_ids(d['stanford_deprel'], constant.DEPREL_TO_ID)
-            l = len(tokens)
-            subj_positions = get_positions(d['subj_start'], d['subj_end'], l)
-            obj_positions = get_positions(d['obj_start'], d['obj_end'], l)
-            relation = constant.LABEL_TO_ID[d['relation']]
-
-            base_processed += [(tokens, pos, ner, deprel, subj_positions, obj_positions, relation)]
-            if self.fact_checking_component:
-                entity_masks = self.add_entity_masks(length=len(tokens), subj_span=(ss, se), obj_span=(os, oe))
-                supplemental_components['entity_masks'] += [entity_masks]
-
-        # transform to arrays for easier manipulations
-        for name in supplemental_components.keys():
-            supplemental_components[name] = np.array(supplemental_components[name])
-        return {'base': np.array(base_processed), 'supplemental': supplemental_components}
+        return PreprocessedData.from_examples(self.preprocess_example(d, vocab, opt) for d in data)
+
+    def preprocess_example(self, d, vocab, opt):
+        """ Preprocess a single example dict and convert it to ids. """
+        tokens = d['token']
+        if opt['lower']:
+            tokens = [t.lower() for t in tokens]
+        # anonymize tokens
+        ss, se = d['subj_start'], d['subj_end']
+        os, oe = d['obj_start'], d['obj_end']
+        if self.remove_entity_types:
+            tokens[ss:se + 1] = ['SUBJ'] * (se - ss + 1)
+            tokens[os:oe + 1] = ['OBJ'] * (oe - os + 1)
+        else:
+            tokens[ss:se+1] = ['SUBJ-'+d['subj_type']] * (se-ss+1)
+            tokens[os:oe+1] = ['OBJ-'+d['obj_type']] * (oe-os+1)
+
+        tokens = map_to_ids(tokens, vocab.word2id)
+        pos = map_to_ids(d['stanford_pos'], constant.POS_TO_ID)
+        ner = map_to_ids(d['stanford_ner'], constant.NER_TO_ID)
+        deprel = map_to_ids(d['stanford_deprel'], constant.DEPREL_TO_ID)
+        l = len(tokens)
+        subj_positions = get_positions(d['subj_start'], d['subj_end'], l)
+        obj_positions = get_positions(d['obj_start'], d['obj_end'], l)
+        # unlabeled examples (e.g. inference requests) default to no_relation
+        relation = constant.LABEL_TO_ID[d.get('relation', 'no_relation')]
+        return {'tokens': tokens, 'pos': pos, 'ner': ner, 'deprel': deprel,
+                'subj_positions': subj_positions, 'obj_positions': obj_positions,
+                'relation': relation, 'entity_span': (ss, se, os, oe)}
 
     def gold(self):
         """ Return gold labels as a list. """
-        return self.labels
+        id2label = dict([(v,k) for k,v in constant.LABEL_TO_ID.items()])
+        return [id2label[r] for r in self.gold_ids().tolist()]
+
+    def gold_ids(self):
+        """ Return gold label ids as an int array. """
+        return self.label_ids
 
     def __len__(self):
         return len(self.data)
 
-    def ready_base_batch(self, base_batch, batch_size):
-        batch = list(zip(*base_batch))
-        assert len(batch) == 7
-
-        # sort all fields by lens for easy RNN operations
-        lens = [len(x) for x in batch[0]]
-        batch, orig_idx = sort_all(batch, lens)
+    def ready_base_batch(self, dataset, indices, token_mask, rng=None):
+        positions = dataset.offsets[indices][:, None] + np.arange(token_mask.shape[1])
+        positions = positions[token_mask]
+        fields = dict((name, get_padded_array(dataset.fields[name], positions, token_mask))
+                      for name in BASE_FIELDS)
 
         # word dropout
+        words = fields['tokens']
         if not self.eval:
-            words = [word_dropout(sent, self.opt['word_dropout']) for sent in batch[0]]
-        else:
-            words = batch[0]
+            words = word_dropout(words, self.opt['word_dropout'], rng)
 
         # convert to tensors
-        words = get_long_tensor(words, batch_size)
+        words = torch.from_numpy(words)
         masks = torch.eq(words, 0)
-        pos = get_long_tensor(batch[1], batch_size)
-        ner = get_long_tensor(batch[2], batch_size)
-        deprel = get_long_tensor(batch[3], batch_size)
-        subj_positions = get_long_tensor(batch[4], batch_size)
-        obj_positions = get_long_tensor(batch[5], batch_size)
-
-        rels = torch.LongTensor(batch[6])
-
-        merged_components = (words, masks, pos, ner, deprel, subj_positions, obj_positions, rels, orig_idx)
-        return {'base': merged_components, 'sentence_lengths': lens}
-
-    def ready_masks_batch(self, masks_batch, batch_size, sentence_lengths):
-        batch = list(zip(*masks_batch))
-        # sort all fields by lens for easy RNN operations
-        batch, _ = sort_all(batch, sentence_lengths)
-
-        subj_masks = get_long_tensor(batch[0], batch_size)
-        obj_masks = get_long_tensor(batch[1], batch_size)
-        merged_components = (subj_masks, obj_masks)
+        pos = torch.from_numpy(fields['pos'])
+        ner = torch.from_numpy(fields['ner'])
+        deprel = torch.from_numpy(fields['deprel'])
+        subj_positions = torch.from_numpy(fields['subj_positions'])
+        obj_positions = torch.from_numpy(fields['obj_positions'])
+
+        rels = torch.from_numpy(dataset.relations[indices].astype(np.int64))
+        return (words, masks, pos, ner, deprel, subj_positions, obj_positions, rels)
+
+    def ready_masks_batch(self, dataset, indices, token_mask):
+        spans = dataset.entity_spans[indices]
+        columns = np.arange(token_mask.shape[1])
+        subj_masks = (columns >= spans[:, 0:1]) & (columns <= spans[:, 1:2])
+        obj_masks = (columns >= spans[:, 2:3]) & (columns <= spans[:, 3:4])
+        merged_components = (torch.from_numpy(subj_masks.astype(np.int64)),
+                             torch.from_numpy(obj_masks.astype(np.int64)))
         return merged_components
 
-    def ready_data_batch(self, batch):
-        batch_size = len(batch['base'])
-        readied_batch = self.ready_base_batch(batch['base'], batch_size)
-        readied_batch['supplemental'] = dict()
+    def ready_data_batch(self, dataset, indices, rng=None):
+        # sort all fields by lens for easy RNN operations
+        offsets = dataset.offsets
+        lens, orig_idx = sort_by_length(offsets[indices + 1] - offsets[indices])
+        indices = indices[orig_idx]
+        token_mask = np.arange(lens[0])[None, :] < lens[:, None]
+
+        base_components = self.ready_base_batch(dataset, indices, token_mask, rng)
+        readied_batch = {'base': base_components + (torch.from_numpy(orig_idx),),
+                         'sentence_lengths': lens.tolist(),
+                         'supplemental': dict()}
         readied_supplemental = readied_batch['supplemental']
-        for name, supplemental_batch in batch['supplemental'].items():
-            if name == 'entity_masks':
-                readied_supplemental[name] = self.ready_masks_batch(
-                    masks_batch=supplemental_batch,
-                    batch_size=batch_size,
-                    sentence_lengths=readied_batch['sentence_lengths'])
+        if self.fact_checking_component:
+            readied_supplemental['entity_masks'] = self.ready_masks_batch(dataset, indices, token_mask)
         return readied_batch
 
     def __getitem__(self, key):
@@ -176,13 +305,156 @@ class DataLoader(object):
         if key < 0 or key >= len(self.data):
             raise IndexError
         batch = self.data[key]
-        batch = self.ready_data_batch(batch)
+        batch = self.ready_data_batch(self.dataset, batch)
         return batch
 
+    def get_batch(self, key, seed):
+        """ Get a batch with index, drawing word dropout from a generator seeded by seed and key. """
+        rng = np.random.RandomState((seed + key) % 2 ** 32)
+        batch = self.ready_data_batch(self.dataset, self.data[key], rng)
+        if self.pin_memory:
+            batch = pin_batch(batch)
+        return batch
+
+    def __iter__(self):
+        # one seed per pass from the global generator keeps batches reproducible under the
+        # configured seed, regardless of which thread builds them
+        seed = np.random.randint(2 ** 31) if not self.eval else 0
+        if self.prefetch_depth <= 0:
+            for i in range(self.__len__()):
+                yield self.get_batch(i, seed)
+            return
+        with ThreadPoolExecutor(max_workers=self.prefetch_workers) as executor:
+            pending = deque()
+            for i in range(self.__len__()):
+                pending.append(executor.submit(self.get_batch, i, seed))
+                if len(pending) > self.prefetch_depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+class StreamingDataLoader(DataLoader):
+    """
+    Stream examples from a JSON array or JSON-lines file, preprocessing them on the fly
+    and shuffling them through a bounded buffer, so memory stays constant regardless of
+    the corpus size. Gold labels are those of the most recent pass.
+    """
+    def __init__(self, filename, batch_size, opt, vocab, evaluation=False):
+        self.init_options(batch_size, opt, vocab, evaluation)
+        self.filename = filename
+        self.shuffle_buffer_size = opt.get('shuffle_buffer', 10000)
+
+        # a cheap first pass to know the number of batches per epoch
+        self.num_examples = sum(1 for _ in iter_json(filename))
+        self.num_batches = (self.num_examples + batch_size - 1) // batch_size
+        # with several ranks, a final batch too small to be shared by all of them is dropped
+        if 0 < self.num_examples % batch_size < self.world_size:
+            self.num_batches -= 1
+        self.label_ids = []
+        print("{} batches to be streamed from {}".format(self.num_batches, filename))
+
+    def __len__(self):
+        return self.num_batches
+
+    def __getitem__(self, key):
+        raise TypeError("Streamed batches can only be iterated over.")
 
     def __iter__(self):
-        for i in range(self.__len__()):
-            yield self.__getitem__(i)
+        seed = np.random.randint(2 ** 31) if not self.eval else 0
+        # raw examples are shuffled and batched, so each rank only preprocesses its own share
+        examples = iter_json(self.filename)
+        if not self.eval:
+            examples = shuffle_buffer(examples, self.shuffle_buffer_size, np.random.RandomState(seed))
+
+        self.label_ids = []
+        chunk = []
+        key = 0
+        for example in examples:
+            chunk.append(example)
+            if len(chunk) == self.batch_size:
+                yield self.stream_batch(self.shard(chunk), key, seed)
+                chunk = []
+                key += 1
+        if len(chunk) >= self.world_size:
+            yield self.stream_batch(self.shard(chunk), key, seed)
+
+    def gold_ids(self):
+        if len(self.label_ids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(self.label_ids)
+
+    def stream_batch(self, examples, key, seed):
+        dataset = self.preprocess(examples, self.vocab, self.opt)
+        self.label_ids.append(dataset.relations)
+        rng = np.random.RandomState((seed + key) % 2 ** 32)
+        batch = self.ready_data_batch(dataset, np.arange(len(dataset)), rng)
+        if self.pin_memory:
+            batch = pin_batch(batch)
+        return batch
+
+class ExampleBatcher(DataLoader):
+    """
+    Preprocess and collate in-memory example dicts, e.g. the examples of inference
+    requests, into evaluation batches.
+    """
+    def __init__(self, opt, vocab):
+        self.init_options(opt['batch_size'], opt, vocab, evaluation=True)
+        self.pin_memory = False
+
+    def preprocess_examples(self, examples):
+        """
+        Validate and preprocess example dicts, raising ValueError on the first malformed one.
+        The results can be collated together with those of other calls by batch.
+        """
+        processed = []
+        for i, d in enumerate(examples):
+            try:
+                check_example(d)
+                # preprocess_example anonymizes the tokens in place
+                example = self.preprocess_example(dict(d, token=list(d['token'])), self.vocab, self.opt)
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                raise ValueError("Example {}: {}".format(i, repr(e)))
+            processed.append(example)
+        return processed
+
+    def batch(self, processed):
+        """ Collate examples returned by preprocess_examples into a single batch. """
+        dataset = PreprocessedData.from_examples(processed)
+        return self.ready_data_batch(dataset, np.arange(len(dataset)))
+
+def check_example(d):
+    """ Raise ValueError if an example dict cannot be preprocessed and collated. """
+    length = len(d['token'])
+    if length == 0:
+        raise ValueError("Empty token list.")
+    for key in ['stanford_pos', 'stanford_ner', 'stanford_deprel']:
+        if len(d[key]) != length:
+            raise ValueError("{} has {} tokens, expected {}.".format(key, len(d[key]), length))
+    for start_key, end_key in [('subj_start', 'subj_end'), ('obj_start', 'obj_end')]:
+        start, end = d[start_key], d[end_key]
+        if not (isinstance(start, int) and isinstance(end, int) and 0 <= start <= end < length):
+            raise ValueError("{}, {} = ({}, {}) are out of the {} tokens.".format(start_key, end_key, start, end, length))
+
+def shuffle_buffer(iterable, size, rng):
+    """ Approximately shuffle an iterable by sampling from a buffer of at most size items. """
+    buffer = []
+    for item in iterable:
+        if len(buffer) < size:
+            buffer.append(item)
+            continue
+        i = rng.randint(size)
+        yield buffer[i]
+        buffer[i] = item
+    for i in rng.permutation(len(buffer)):
+        yield buffer[i]
+
+def file_digest(filename):
+    """ SHA1 digest of a file's contents, read in chunks. """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
 
 def map_to_ids(tokens, vocab):
     ids = [vocab[t] if t in vocab else constant.UNK_ID for t in tokens]
@@ -193,22 +465,45 @@ def get_positions(start_idx, end_idx, length):
     return list(range(-start_idx, 0)) + [0]*(end_idx - start_idx + 1) + \
             list(range(1, length-end_idx))
 
-def get_long_tensor(tokens_list, batch_size):
-    """ Convert list of list of tokens to a padded LongTensor. """
-    token_len = max(len(x) for x in tokens_list)
-    tokens = torch.LongTensor(batch_size, token_len).fill_(constant.PAD_ID)
-    for i, s in enumerate(tokens_list):
-        tokens[i, :len(s)] = torch.LongTensor(s)
-    return tokens
-
-def sort_all(batch, lens):
-    """ Sort all fields by descending order of lens, and return the original indices. """
-    unsorted_all = [lens] + [range(len(lens))] + list(batch)
-    sorted_all = [list(t) for t in zip(*sorted(zip(*unsorted_all), reverse=True))]
-    return sorted_all[2:], sorted_all[1]
+def get_padded_array(buffer, positions, token_mask):
+    """ Gather the tokens at positions of a flat buffer into a padded [batch, max_len] array. """
+    padded = np.full(token_mask.shape, constant.PAD_ID, dtype=np.int64)
+    padded[token_mask] = buffer[positions]
+    return padded
 
-def word_dropout(tokens, dropout):
-    """ Randomly dropout tokens (IDs) and replace them with <UNK> tokens. """
-    return [constant.UNK_ID if x != constant.UNK_ID and np.random.random() < dropout \
-            else x for x in tokens]
+def sort_by_length(lens):
+    """
+    Sort lens in descending order, and return the original indices. Ties are
+    broken by descending original index.
+    """
+    orig_idx = np.argsort(lens, kind='stable')[::-1].copy()
+    return lens[orig_idx], orig_idx
 
+def split_by_token_budget(indices, lengths, max_tokens):
+    """
+    Split indices sorted by ascending lengths into batches whose padded size
+    (number of examples x longest length) stays within max_tokens.
+    """
+    batches = []
+    batch_start = 0
+    for i in range(len(indices)):
+        if i > batch_start and (i - batch_start + 1) * lengths[i] > max_tokens:
+            batches.append(indices[batch_start: i])
+            batch_start = i
+    if batch_start < len(indices):
+        batches.append(indices[batch_start:])
+    return batches
+
+def pin_batch(batch):
+    """ Move all tensors of a readied batch to page-locked memory for asynchronous copies. """
+    batch['base'] = tuple(c.pin_memory() if torch.is_tensor(c) else c for c in batch['base'])
+    for name, components in batch['supplemental'].items():
+        batch['supplemental'][name] = tuple(c.pin_memory() for c in components)
+    return batch
+
+def word_dropout(tokens, dropout, rng=None):
+    """ Randomly dropout tokens (IDs) of a padded array and replace them with <UNK> tokens. """
+    rng = np.random if rng is None else rng
+    drop = (rng.random_sample(tokens.shape) < dropout) & (tokens != constant.PAD_ID)
+    tokens[drop] = constant.UNK_ID
+    return tokens
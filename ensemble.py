@@ -2,20 +2,17 @@
 Ensemble the predictions from different model outputs.
 """
 import argparse
-import json
-import pickle
 import numpy as np
-from collections import Counter
 
-from data.loader import DataLoader
-from utils import scorer, constant
+from utils import scorer, constant, helper
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('pred_files', nargs='+', help='A list of prediction files written by eval.py.')
+    parser.add_argument('pred_files', nargs='+', help='A list of probability files (.npy or .pkl) written by eval.py.')
     parser.add_argument('--data_dir', default='dataset/tacred')
     parser.add_argument('--dataset', default='test', help='Evaluate on dev or test set.')
-    parser.add_argument('--weights', default='')
+    parser.add_argument('--weights', default='', help='Space separated weight of each model; uniform by default.')
+    parser.add_argument('--method', default='', help='vote, average or logprob; vote without weights and average with them by default.')
     args = parser.parse_args()
     return args
 
@@ -23,52 +20,80 @@ def main():
     args = parse_args()
     print("Loading data file...")
     filename = args.data_dir + '/{}.json'.format(args.dataset)
-    with open(filename, 'r') as infile:
-        data = json.load(infile, encoding='utf8')
-    labels = [d['relation'] for d in data]
+    labels = np.array([constant.LABEL_TO_ID[d['relation']] for d in helper.iter_json(filename)], dtype=np.int64)
 
     # read predictions
     print("Loading {} prediction files...".format(len(args.pred_files)))
-    scores_list = []
-    for path in args.pred_files:
-        with open(path, 'rb') as infile:
-            scores = pickle.load(infile)
-            scores_list += [scores]
-    
+    probs = stack_probs(args.pred_files)
+    assert probs.shape[1] == len(labels), "Prediction files must have one row per example."
+
+    weights, method = ensemble_options(args.weights, args.method, len(probs))
+
     print("Calculating ensembled predictions...")
-    predictions = []
-    scores_by_examples = list(zip(*scores_list))
-    assert len(scores_by_examples) == len(data)
-    for scores in scores_by_examples:
-        if len(args.weights) == 0:
-            pred = ensemble(scores)
-        else:
-            pred = weight_sum(scores, args.weights)
-        predictions += [pred]
-    id2label = dict([(v,k) for k,v in constant.LABEL_TO_ID.items()])
-    predictions = [id2label[p] for p in predictions]
-    scorer.score(labels, predictions, verbose=True)
+    predictions, _ = ensemble(probs, weights, method)
+    scorer.score_ids(labels, predictions, constant.ID_TO_LABEL, verbose=True)
+
+def ensemble_options(weights, method, num_models):
+    """ Parse the --weights and --method arguments: uniform vote without weights, average with them by default. """
+    if len(weights) > 0:
+        weight_array = np.array([float(w) for w in weights.split()], dtype=np.float32)
+        assert len(weight_array) == num_models, "Need one weight per model."
+    else:
+        weight_array = np.ones(num_models, dtype=np.float32)
+    if len(method) == 0:
+        method = 'average' if len(weights) > 0 else 'vote'
+    return weight_array, method
 
-def ensemble(scores):
+def ensemble(probs, weights, method):
     """
-    Ensemble by majority vote.
+    Ensemble stacked (models x examples x classes) probabilities with method. Returns the
+    predictions and the ensembled probabilities; votes come with the averaged probabilities.
     """
-    c = Counter()
-    for probs in zip(scores):
-        idx = int(np.argmax(np.array(probs)))
-        c.update([idx])
-    best = c.most_common(1)[0][0]
-    return best
+    if method == 'vote':
+        return majority_vote(probs, weights), weighted_average(probs, weights)
+    elif method == 'average':
+        ensembled_probs = weighted_average(probs, weights)
+    elif method == 'logprob':
+        ensembled_probs = log_prob_average(probs, weights)
+    else:
+        raise ValueError('Only, {vote, average, and logprob} ensembles are supported')
+    return ensembled_probs.argmax(1), ensembled_probs
 
-def weight_sum(scores, weights):
-    weights = list(map(lambda x: float(x), weights.split(' ')))
-    aggregate_scores = np.zeros(len(scores[0]))
-    for model_scores, weight in zip(scores, weights):
-        scores_weights = np.array(model_scores) * weight
-        aggregate_scores += scores_weights
-    best = int(np.argmax(aggregate_scores))
-    return best
+def stack_probs(pred_files):
+    """ Stack the probabilities of each file into a float32 (models x examples x classes) array. """
+    first = helper.load_probs(pred_files[0])
+    probs = np.empty((len(pred_files),) + first.shape, dtype=np.float32)
+    probs[0] = first
+    for i, path in enumerate(pred_files[1:], 1):
+        model_probs = helper.load_probs(path)
+        assert model_probs.shape == first.shape, "{} has shape {}, expected {}.".format(path, model_probs.shape, first.shape)
+        probs[i] = model_probs
+    return probs
+
+def majority_vote(probs, weights):
+    """
+    Ensemble by (weighted) majority vote. Ties go to the class voted for by the earliest model.
+    """
+    num_models, num_examples, num_classes = probs.shape
+    votes = probs.argmax(2)
+    examples = np.arange(num_examples)
+    counts = np.bincount((votes + examples * num_classes).ravel(), weights=np.repeat(weights, num_examples),
+                         minlength=num_examples * num_classes).reshape(num_examples, num_classes)
+    # per example, whether each model voted for a winning class
+    is_tied = counts[examples, votes] == counts.max(1)
+    first_tied = is_tied.argmax(0)
+    return votes[first_tied, examples]
+
+def weighted_average(probs, weights):
+    """ Ensemble by the weighted average of probabilities. """
+    return np.tensordot(weights / weights.sum(), probs, axes=1)
+
+def log_prob_average(probs, weights):
+    """ Ensemble by the weighted average of log probabilities (a weighted geometric mean), renormalized. """
+    log_probs = np.log(np.maximum(probs, np.finfo(np.float32).tiny))
+    scores = np.tensordot(weights / weights.sum(), log_probs, axes=1)
+    scores = np.exp(scores - scores.max(1, keepdims=True))
+    return scores / scores.sum(1, keepdims=True)
 
 if __name__ == '__main__':
     main()
-
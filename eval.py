@@ -5,22 +5,27 @@ Run evaluation with saved models.
 import os
 import random
 import argparse
-import pickle
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 
 from data.loader import DataLoader
 from model.rnn import RelationModel
+import ensemble
 from utils import torch_utils, scorer, constant, helper
-from utils.vocab import Vocab
+from utils.vocab import Vocab, vocab_file as vocab_path
 
 parser = argparse.ArgumentParser()
-parser.add_argument('model_dir', type=str, help='Directory of the model.')
+parser.add_argument('model_dir', type=str, nargs='+',
+                    help='Directory of the model. With several directories, their models are ensembled over a single pass of the data.')
 parser.add_argument('--model', type=str, default='best_model.pt', help='Name of the model file.')
 parser.add_argument('--data_dir', type=str, default='dataset/tacred')
 parser.add_argument('--dataset', type=str, default='test', help="Evaluate on dev or test.")
-parser.add_argument('--out', type=str, default='', help="Save model predictions to this dir.")
+parser.add_argument('--out', type=str, default='', help="Save model probabilities to this .npy (or legacy .pkl) file.")
+parser.add_argument('--out_dtype', type=str, default='float32', help="Probability dtype of .npy files: float32 or float16.")
+parser.add_argument('--weights', default='', help='Space separated weight of each ensembled model; uniform by default.')
+parser.add_argument('--method', default='', help='Ensemble by vote, average or logprob; vote without weights and average with them by default.')
 
 parser.add_argument('--seed', type=int, default=1234)
 parser.add_argument('--cuda', type=bool, default=torch.cuda.is_available())
@@ -34,44 +39,81 @@ if args.cpu:
 elif args.cuda:
     torch.cuda.manual_seed(args.seed)
 
-# load opt
-model_file = args.model_dir + '/' + args.model
-print("Loading model from {}".format(model_file))
-opt = torch_utils.load_config(model_file)
-model = RelationModel(opt)
-model.load(model_file)
+def load_model(model_dir):
+    model_file = model_dir + '/' + args.model
+    print("Loading model from {}".format(model_file))
+    opt = torch_utils.load_config(model_file)
+    model = RelationModel(opt)
+    model.load(model_file)
 
-# load vocab
-vocab_file = args.model_dir + '/vocab.pkl'
-vocab = Vocab(vocab_file, load=True)
-print('config vocab size: {} | actual size: {}'.format(
-    opt['vocab_size'], vocab.size
-))
+    vocab_file = vocab_path(model_dir)
+    vocab = Vocab(vocab_file, load=True)
+    print('config vocab size: {} | actual size: {}'.format(
+        opt['vocab_size'], vocab.size
+    ))
+    assert opt['vocab_size'] == vocab.size, "Vocab size must match that in the saved model."
+    return model, opt, vocab
+
+def share_embeddings(model, shared_model):
+    """ Point the word embeddings of model at those of shared_model if their weights are identical. """
+    emb, shared_emb = model.model.emb, shared_model.model.emb
+    if emb is shared_emb or emb.weight.shape != shared_emb.weight.shape or not torch.equal(emb.weight, shared_emb.weight):
+        return False
+    model.model.emb = shared_emb
+    return True
+
+def place_batch(model, b):
+    """ Move the batch to the device once, so that every ensembled model reads the same tensors. """
+    inputs, labels, orig_idx = model.maybe_place_batch_on_cuda(b)
+    inputs['base'] = list(inputs['base']) + [labels, orig_idx]
+    return inputs
+
+# load models
+models, opts = [], []
+for model_dir in args.model_dir:
+    model, opt, vocab = load_model(model_dir)
+    if len(models) > 0:
+        assert vocab.id2word == first_vocab.id2word, "Ensembled models must share a vocab to share the data."
+        for key in ['lower', 'remove_entity_types']:
+            assert opt[key] == opts[0][key], "Ensembled models must preprocess the data alike, {} differs.".format(key)
+        if share_embeddings(model, models[0]):
+            print("Sharing word embeddings with {}.".format(args.model_dir[0]))
+    else:
+        first_vocab = vocab
+    models.append(model)
+    opts.append(opt)
+opt = opts[0]
 print('config: {}'.format(opt))
-assert opt['vocab_size'] == vocab.size, "Vocab size must match that in the saved model."
+if len(models) > 1:
+    weights, method = ensemble.ensemble_options(args.weights, args.method, len(models))
+    # the data of any fact checking model covers the others too
+    opt = next((o for o in opts if o['fact_checking_attn'] or
+                (o.get('reg_params') is not None and o['reg_params']['type'] == 'fact_checking')), opt)
 
 # load data
 data_file = opt['data_dir'] + '/{}.json'.format(args.dataset)
 print("Loading data from {} with batch size {}...".format(data_file, opt['batch_size']))
-batch = DataLoader(data_file, opt['batch_size'], opt, vocab, evaluation=True)
+batch = DataLoader(data_file, opt['batch_size'], opt, first_vocab, evaluation=True)
 
 helper.print_config(opt)
-id2label = dict([(v,k) for k,v in constant.LABEL_TO_ID.items()])
-
 predictions = []
 all_probs = []
 for i, b in enumerate(batch):
-    preds, probs, _ = model.predict(b)
-    predictions += preds
-    all_probs += probs
-predictions = [id2label[p] for p in predictions]
-p, r, f1 = scorer.score(batch.gold(), predictions, verbose=True)
+    if len(models) == 1:
+        preds, probs = models[0].infer(b)
+    else:
+        b = place_batch(models[0], b)
+        model_probs = np.stack([model.infer(b)[1] for model in models])
+        preds, probs = ensemble.ensemble(model_probs, weights, method)
+    predictions += preds.tolist()
+    all_probs += [probs]
+all_probs = np.concatenate(all_probs)
+p, r, f1 = scorer.score_ids(batch.gold_ids(), predictions, constant.ID_TO_LABEL, verbose=True)
 
 # save probability scores
 if len(args.out) > 0:
     helper.ensure_dir(os.path.dirname(args.out))
-    with open(args.out, 'wb') as outfile:
-        pickle.dump(all_probs, outfile)
+    helper.save_probs(all_probs, args.out, args.out_dtype)
     print("Prediction scores saved to {}.".format(args.out))
 
 print("Evaluation ended.")
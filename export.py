@@ -0,0 +1,114 @@
+"""
+Export a saved model for deployment, as a TorchScript or ONNX graph with the flat signature
+(words, pos, ner, subj_pos, obj_pos, lengths) -> class probabilities, and check that the
+exported graph matches the eager model on batches of a dataset, removing it if not.
+
+A TorchScript export runs without the training code:
+    model = torch.jit.load('saved_models/00/model.ts')
+    probs = model(words, pos, ner, subj_pos, obj_pos, lengths)
+"""
+
+import os
+import argparse
+import numpy as np
+import torch
+
+from data.loader import DataLoader
+from model.rnn import RelationModel, ExportableRNN
+from utils import torch_utils
+from utils.vocab import Vocab, vocab_file as vocab_path
+
+INPUT_NAMES = ['words', 'pos', 'ner', 'subj_pos', 'obj_pos', 'lengths']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export a relation extraction model.')
+    parser.add_argument('model_dir', type=str, help='Directory of the model.')
+    parser.add_argument('--model', type=str, default='best_model.pt', help='Name of the model file.')
+    parser.add_argument('--format', type=str, default='torchscript', help='torchscript or onnx.')
+    parser.add_argument('--out', type=str, default='', help='Name of the exported file; model.ts or model.onnx by default.')
+    parser.add_argument('--dataset', type=str, default='dev', help='Check parity on dev or test.')
+    parser.add_argument('--num_batches', type=int, default=0, help='Batches to check parity on; 0 for all.')
+    parser.add_argument('--atol', type=float, default=1e-5, help='Max absolute difference of probabilities.')
+    args = parser.parse_args()
+    return args
+
+def flat_inputs(batch):
+    """ The exported model inputs of a batch from DataLoader. """
+    words, masks, pos, ner, deprel, subj_pos, obj_pos = batch['base'][:7]
+    lengths = torch.LongTensor(batch['sentence_lengths'])
+    return words, pos, ner, subj_pos, obj_pos, lengths
+
+def export_torchscript(module, example_inputs, out_file):
+    """ Compile module with torch.jit.script, so no batch or sequence size is baked in. """
+    scripted = torch.jit.script(module)
+    scripted.save(out_file)
+    loaded = torch.jit.load(out_file)
+    return lambda inputs: loaded(*inputs).numpy()
+
+def export_onnx(module, example_inputs, out_file):
+    dynamic_axes = dict((name, {0: 'batch', 1: 'seq_len'}) for name in INPUT_NAMES[:-1])
+    dynamic_axes['lengths'] = {0: 'batch'}
+    dynamic_axes['probs'] = {0: 'batch'}
+    with torch.no_grad():
+        # the dynamo exporter specializes the sequence size through the LSTM, so use the TorchScript one
+        torch.onnx.export(module, example_inputs, out_file, input_names=INPUT_NAMES,
+                          output_names=['probs'], dynamic_axes=dynamic_axes, dynamo=False)
+    try:
+        import onnxruntime
+    except ImportError:
+        print("onnxruntime is not installed, skipping the parity check.")
+        return None
+    session = onnxruntime.InferenceSession(out_file)
+    return lambda inputs: session.run(None, dict((name, x.numpy()) for name, x in zip(INPUT_NAMES, inputs)))[0]
+
+def main():
+    args = parse_args()
+    assert args.format in ['torchscript', 'onnx'], "Only torchscript and onnx exports are supported."
+
+    model_file = os.path.join(args.model_dir, args.model)
+    print("Loading model from {}".format(model_file))
+    opt = torch_utils.load_config(model_file)
+    opt['cuda'] = False
+    opt['precision'] = 'fp32'
+    model = RelationModel(opt)
+    model.load(model_file)
+    model.model.eval()
+    module = ExportableRNN(model.model).eval()
+
+    vocab = Vocab(vocab_path(args.model_dir), load=True)
+    assert opt['vocab_size'] == vocab.size, "Vocab size must match that in the saved model."
+    data_file = opt['data_dir'] + '/{}.json'.format(args.dataset)
+    data_batch = DataLoader(data_file, opt['batch_size'], opt, vocab, evaluation=True)
+
+    default_out = 'model.ts' if args.format == 'torchscript' else 'model.onnx'
+    out_file = os.path.join(args.model_dir, args.out if len(args.out) > 0 else default_out)
+    example_inputs = flat_inputs(data_batch[0])
+    if args.format == 'torchscript':
+        run_exported = export_torchscript(module, example_inputs, out_file)
+    else:
+        run_exported = export_onnx(module, example_inputs, out_file)
+    print("Exported model saved to {}.".format(out_file))
+    if run_exported is None:
+        return
+
+    # parity with the eager model, in the sorted batch order, on batches of different sizes
+    num_batches = len(data_batch) if args.num_batches <= 0 else min(args.num_batches, len(data_batch))
+    max_diff = 0.
+    num_agree, num_examples = 0, 0
+    with torch.no_grad():
+        for i in range(num_batches):
+            batch = data_batch[i]
+            exported_probs = run_exported(flat_inputs(batch))
+            _, eager_probs = model.infer(batch, unsort=False)
+            max_diff = max(max_diff, float(np.abs(exported_probs - eager_probs).max()))
+            num_agree += int((exported_probs.argmax(1) == eager_probs.argmax(1)).sum())
+            num_examples += len(eager_probs)
+    print("Parity on {} {} examples in {} batches: max abs diff = {:.2e}, prediction agreement = {:.4f}".format(
+        num_examples, args.dataset, num_batches, max_diff, num_agree / num_examples))
+    if max_diff > args.atol:
+        os.remove(out_file)
+        raise RuntimeError("Exported model differs from the eager model by {:.2e} > {}, removed {}.".format(
+            max_diff, args.atol, out_file))
+
+if __name__ == '__main__':
+    main()
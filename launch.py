@@ -0,0 +1,183 @@
+"""
+Train several seeds or configs of a model concurrently, e.g.
+
+    python launch.py --seeds 1234 17 1776 2019 420 --threads 4
+    python launch.py --runs "lr=0.5" "lr=1.0 hidden_dim=100" --seeds 1234 17
+
+Every run is a train.py process limited to --threads threads. The data is preprocessed once
+into a memory-mapped cache, and the cache, vocab and embedding matrix are staged in shared
+memory (--shm_dir), so that all runs read a single copy of them. The staged copies are removed
+once the runs finish.
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import subprocess
+import multiprocessing
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from data.loader import DataLoader
+from utils import helper
+from utils.config import default_config_path, load_model_config, parse_overrides
+from utils.vocab import Vocab, vocab_file as vocab_path
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Train several runs of a model concurrently.')
+    parser.add_argument('--config', type=str, default='', help='Model config yaml; defaults to the one train.py uses.')
+    parser.add_argument('--seeds', type=int, nargs='*', default=[], help='Seeds to train each run with; the config seed by default.')
+    parser.add_argument('--runs', type=str, nargs='*', default=[''],
+                        help='Space separated KEY=VALUE config overrides of each run.')
+    parser.add_argument('--set', type=str, nargs='*', default=[], metavar='KEY=VALUE', help='Config overrides of every run.')
+    parser.add_argument('--id_prefix', type=str, default='', help='Runs are saved under <id_prefix>-<run number>; the config id by default.')
+    parser.add_argument('--workers', type=int, default=0, help='Concurrent runs; as many as the cores allow by default.')
+    parser.add_argument('--threads', type=int, default=1, help='Torch threads per run.')
+    parser.add_argument('--gpus', type=str, nargs='*', default=[], help='GPUs to assign to runs round robin; runs use cpu otherwise.')
+    parser.add_argument('--shm_dir', type=str, default='/dev/shm/tacred',
+                        help="Shared memory directory for the data cache, vocab and embeddings; 'None' to keep them in place.")
+    args = parser.parse_args()
+    return args
+
+def stage_file(filename, target_dir):
+    """ Copy filename into target_dir unless an identical copy is there already. Returns the copy. """
+    target = os.path.join(target_dir, os.path.basename(filename))
+    source_stat = os.stat(filename)
+    if os.path.exists(target):
+        target_stat = os.stat(target)
+        if target_stat.st_size == source_stat.st_size and target_stat.st_mtime == source_stat.st_mtime:
+            return target
+    shutil.copy2(filename, target)
+    return target
+
+def stage_shared_data(opt, shm_dir):
+    """ Overrides pointing runs at the vocab, embeddings and data cache in shm_dir. """
+    vocab_dir = os.path.join(shm_dir, 'vocab')
+    helper.ensure_dir(vocab_dir, verbose=False)
+    stage_file(vocab_path(opt['vocab_dir']), vocab_dir)
+    stage_file(os.path.join(opt['vocab_dir'], 'embedding.npy'), vocab_dir)
+    return {'vocab_dir': vocab_dir, 'cache_dir': os.path.join(shm_dir, 'cache')}
+
+def warm_cache(opt):
+    """ Preprocess every split into the data cache, so that runs only load it. """
+    opt = dict(opt, cuda=False)
+    vocab = Vocab(vocab_path(opt['vocab_dir']), load=True)
+    for split in ['train', 'dev', 'test']:
+        DataLoader(opt['data_dir'] + '/{}.json'.format(split), opt['batch_size'], opt, vocab, evaluation=True)
+
+def build_runs(args, base_id):
+    """ One dict of raw KEY=VALUE overrides per run: every --runs config with every seed. """
+    id_prefix = args.id_prefix if len(args.id_prefix) > 0 else base_id
+    seeds = args.seeds if len(args.seeds) > 0 else [None]
+    runs = []
+    for run_config in args.runs:
+        for seed in seeds:
+            overrides = parse_overrides(args.set)
+            overrides.update(parse_overrides(run_config.split()))
+            if seed is not None:
+                overrides['seed'] = str(seed)
+            overrides['id'] = '{}-{:02d}'.format(id_prefix, len(runs) + 1)
+            runs.append(overrides)
+    return runs
+
+def run_training(config_path, overrides, threads, gpu, log_file):
+    """ Train one run in a train.py process. Returns its exit code and wall time in minutes. """
+    env = dict(os.environ)
+    for name in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        env[name] = str(threads)
+    env['CUDA_VISIBLE_DEVICES'] = gpu
+    command = [sys.executable, 'train.py', '--config', config_path, '--set']
+    command += ['{}={}'.format(key, value) for key, value in overrides.items()]
+    start_time = time.time()
+    with open(log_file, 'w') as log:
+        returncode = subprocess.call(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return returncode, (time.time() - start_time) / 60
+
+def load_summary_f1s(summary_file):
+    """ Best dev F1 and test F1 at best dev of a run, or None if it never finished evaluating. """
+    try:
+        summary = helper.load_config(summary_file, verbose=False)
+        dev_f1, test_f1 = float(summary['best_dev']['f1']), float(summary['test_at_best_dev']['f1'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    # metrics stay -inf until the first evaluation
+    if not (np.isfinite(dev_f1) and np.isfinite(test_f1)):
+        return None
+    return dev_f1, test_f1
+
+def print_summary(runs, results, opts):
+    """ Print best dev and test at best dev F1 of every run, with their mean and std. """
+    print('{:<28}{:>8}{:>10}{:>10}{:>10}  {}'.format('id', 'seed', 'dev F1', 'test F1', 'minutes', 'overrides'))
+    dev_f1s, test_f1s = [], []
+    for overrides, (returncode, minutes), opt in zip(runs, results, opts):
+        summary_file = os.path.join(opt['save_dir'], opt['id'], 'summary.json')
+        extra = ' '.join('{}={}'.format(k, v) for k, v in overrides.items() if k not in ['id', 'seed'])
+        f1s = load_summary_f1s(summary_file) if returncode == 0 else None
+        if f1s is None:
+            status = 'failed ({})'.format(returncode) if returncode != 0 else 'not evaluated'
+            print('{:<28}{:>8}{:>20}{:>10.1f}  {}'.format(opt['id'], opt['seed'], status, minutes, extra))
+            continue
+        dev_f1, test_f1 = f1s
+        dev_f1s.append(dev_f1)
+        test_f1s.append(test_f1)
+        print('{:<28}{:>8}{:>10.4f}{:>10.4f}{:>10.1f}  {}'.format(opt['id'], opt['seed'], dev_f1, test_f1, minutes, extra))
+    if len(dev_f1s) > 1:
+        print('{:<36}{:>10.4f}{:>10.4f}'.format('mean', np.mean(dev_f1s), np.mean(test_f1s)))
+        print('{:<36}{:>10.4f}{:>10.4f}'.format('std', np.std(dev_f1s), np.std(test_f1s)))
+
+def remove_shared_data(shm_dir):
+    """ Remove the vocab and data cache staged by stage_shared_data, and shm_dir if left empty. """
+    for name in ['vocab', 'cache']:
+        shutil.rmtree(os.path.join(shm_dir, name), ignore_errors=True)
+    if os.path.isdir(shm_dir) and len(os.listdir(shm_dir)) == 0:
+        os.rmdir(shm_dir)
+
+def main():
+    args = parse_args()
+    config_path = os.path.abspath(args.config if len(args.config) > 0 else default_config_path())
+    base_opt = load_model_config(config_path, parse_overrides(args.set))
+
+    shared = {'cache_mmap': 'True'}
+    try:
+        if args.shm_dir != 'None':
+            print("Staging vocab and embeddings in {}...".format(args.shm_dir))
+            shared.update(stage_shared_data(base_opt, args.shm_dir))
+        runs = build_runs(args, base_opt['id'])
+        for overrides in runs:
+            overrides.update(dict((k, v) for k, v in shared.items() if k not in overrides))
+        opts = [load_model_config(config_path, overrides) for overrides in runs]
+
+        # preprocess once per distinct preprocessing setup; runs with the same one share the cache
+        warmed = set()
+        for opt in opts:
+            key = (opt['data_dir'], opt['vocab_dir'], opt['lower'], opt['remove_entity_types'])
+            if key not in warmed and opt['cache_dir'] != 'None' and not opt.get('streaming', False):
+                print("Preprocessing data for {}...".format(opt['id']))
+                warm_cache(opt)
+                warmed.add(key)
+
+        workers = args.workers if args.workers > 0 else max(1, multiprocessing.cpu_count() // args.threads)
+        if len(args.gpus) > 0:
+            workers = min(workers, len(args.gpus))
+        log_dir = os.path.join(base_opt['save_dir'], 'launch_logs')
+        helper.ensure_dir(log_dir, verbose=False)
+        print("Training {} runs, {} at a time with {} threads each. Logs are in {}.".format(
+            len(runs), workers, args.threads, log_dir))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = []
+            for i, (overrides, opt) in enumerate(zip(runs, opts)):
+                gpu = args.gpus[i % len(args.gpus)] if len(args.gpus) > 0 else ''
+                log_file = os.path.join(log_dir, '{}.log'.format(opt['id']))
+                futures.append(pool.submit(run_training, config_path, overrides, args.threads, gpu, log_file))
+            results = [future.result() for future in futures]
+        print_summary(runs, results, opts)
+    finally:
+        if args.shm_dir != 'None':
+            print("Removing staged data from {}...".format(args.shm_dir))
+            remove_shared_data(args.shm_dir)
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,25 @@ import torch
 import numpy as np
 import os
 from torch import nn
-
+import torch.nn.functional as F
+
+from utils import torch_utils
+
+
+def packed_batch_sizes(masks):
+    """
+    Like the batch sizes of a packed sequence: the number of rows of masks (batch_size *
+    seq_len, 1 for tokens) still active at each step, once rows are sorted by decreasing
+    length. Also returns the sorting order of the rows, or None if they are already sorted
+    (as DataLoader batches are).
+    """
+    lengths = masks.ne(0).long().sum(1)
+    order = None
+    if not bool((lengths[:-1] >= lengths[1:]).all()):
+        lengths, order = lengths.sort(descending=True)
+    steps = torch.arange(masks.size(1), device=lengths.device)
+    batch_sizes = (lengths.view(1, -1) > steps.view(-1, 1)).sum(1).tolist()
+    return batch_sizes, order
 
 class ReLUBlock(nn.Module):
     def __init__(self, input_size, output_size):
@@ -124,18 +142,61 @@ class NASCell(nn.Module):
              ]
         )
 
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+
+    def project_inputs(self, inputs):
+        """ The input half of the linear0_0 projection, for inputs of any leading shape. """
+        return F.linear(inputs, self.linear0_0.network[0].weight[:, :self.input_size])
+
+    def fused_weights(self):
+        """
+        Weights of sibling blocks that read the same node, concatenated so that each group
+        runs as one matmul: relu1_0/relu1_1/relu1_2 on the mixed inputs, tanh2_0/relu1_1 on
+        relu1_0, tanh2_2/tanh2_3 on relu1_2, tanh3_0/tanh3_1 on tanh2_0 and
+        linear4_0/sigmoid4_1 on tanh3_0.
+        """
+        weight = lambda block: block.network[0].weight
+        groups = [[self.relu1_0, self.relu1_1, self.relu1_2],
+                  [self.tanh2_0, self.relu1_1],
+                  [self.tanh2_2, self.tanh2_3],
+                  [self.tanh3_0, self.tanh3_1],
+                  [self.linear4_0, self.sigmoid4_1]]
+        return [torch.cat([weight(block) for block in group], dim=0) for group in groups]
+
     def forward(self, inputs, hidden):
-        concat_inps = torch.cat([inputs, hidden], dim=-1)
-        mixed_inps = self.linear0_0(concat_inps)
-
-        output = self.branch0(mixed_inps)
-        output += self.branch1(mixed_inps)
-        output += self.branch2(mixed_inps)
-        output += self.branch3(mixed_inps)
-        output += self.branch4(mixed_inps)
-        output += self.branch5(mixed_inps)
-        output += self.branch6(mixed_inps)
-        output /= 7.
+        return self.step(self.project_inputs(inputs), hidden)
+
+    def step(self, input_projs, hidden, fused_weights=None):
+        """
+        Evaluate the branches as a DAG: every shared node (relu1_0, tanh2_0, tanh3_0, ...) is
+        computed once, and siblings reading the same node share a matmul (see fused_weights).
+        Pass fused_weights when stepping through a sequence, to only concatenate them once.
+        """
+        if fused_weights is None:
+            fused_weights = self.fused_weights()
+        weights_1, weights_2_0, weights_2_2, weights_3, weights_4 = fused_weights
+        mixed_inps = input_projs + F.linear(hidden, self.linear0_0.network[0].weight[:, self.input_size:])
+
+        relu1_0, relu1_1, relu1_2 = F.relu(F.linear(mixed_inps, weights_1)).split(self.hidden_size, dim=-1)
+        # relu2_1 is relu1_1 applied to relu1_0, as in branch1
+        tanh2_0, relu2_1 = F.linear(relu1_0, weights_2_0).split(self.hidden_size, dim=-1)
+        tanh2_0 = torch.tanh(tanh2_0)
+        relu2_1 = F.relu(relu2_1)
+        tanh2_2, tanh2_3 = torch.tanh(F.linear(relu1_2, weights_2_2)).split(self.hidden_size, dim=-1)
+        tanh3_0, tanh3_1 = torch.tanh(F.linear(tanh2_0, weights_3)).split(self.hidden_size, dim=-1)
+        linear4_0, sigmoid4_1 = F.linear(tanh3_0, weights_4).split(self.hidden_size, dim=-1)
+        sigmoid4_1 = torch.sigmoid(sigmoid4_1)
+
+        # branch outputs, summed in the original branch order
+        output = linear4_0              # branch0
+        output = output + relu2_1       # branch1
+        output = output + tanh3_1       # branch2
+        output = output + sigmoid4_1    # branch3
+        output = output + relu1_1       # branch4
+        output = output + tanh2_2       # branch5
+        output = output + tanh2_3       # branch6
+        output = output / 7.
         return output
 
 
@@ -153,15 +214,25 @@ class NASCell3Layer(nn.Module):
         self.activations_0 = lambda x:x
         self.activations_1 = torch.nn.ReLU()
         self.activations_2 = torch.nn.ReLU()
+        self.input_size = input_size
         self.hidden_size = hidden_size
 
         self.network = nn.ModuleList(self.layers)
 
+    def project_inputs(self, inputs):
+        """
+        The input half of the first layer projection, for inputs of any leading shape (e.g. a
+        whole [B, T, I] sequence in one matmul). See step.
+        """
+        return F.linear(inputs, self.layer_0.network[0].weight[:, :self.input_size])
+
     def forward(self, inputs, hidden):
-        # concatenate initial inputs
-        layer_concat_inputs = torch.cat([inputs, hidden], dim=1)
-        # first layer
-        layer_outputs = self.layer_0(layer_concat_inputs)
+        return self.step(self.project_inputs(inputs), hidden)
+
+    def step(self, input_projs, hidden):
+        """ Advance the cell from hidden, given the projected inputs of the step. """
+        # first layer, adding the hidden half of the projection
+        layer_outputs = input_projs + F.linear(hidden, self.layer_0.network[0].weight[:, self.input_size:])
         layer_h, layer_t = layer_outputs.split(self.hidden_size, dim=1)
         layer_t = torch.sigmoid(layer_t)
         layer_h = self.activations_0(layer_h)
@@ -222,25 +293,46 @@ class NASMLP3Layer(nn.Module):
 
 
 class NASRNN(nn.Module):
-    def __init__(self, input_size, hidden_size):
+    def __init__(self, input_size, hidden_size, packed=True):
         super(NASRNN, self).__init__()
 
         self.hidden_size = hidden_size
+        # only run each row up to its length, see forward
+        self.packed = packed
         # replace this with whatever you want
         self.rnn = NASCell3Layer(input_size=input_size, hidden_size=hidden_size)
 
     def forward(self, inputs, hidden, masks):
-
-        outputs = []
-        length = inputs.size()[1]
-        for t in range(length):
-            x_t = inputs[:, t, :]
-            hidden = self.rnn(inputs=x_t, hidden=hidden)
-            outputs.append(hidden)
-
-        outputs = torch.stack(outputs, 1)
-        # enforce EoS padding
-        outputs *= masks.view(-1, length, 1)
+        """
+        inputs : batch_size * seq_len * input_size
+        hidden : batch_size * hidden_size
+        masks : batch_size * seq_len, 1 for tokens and 0 for EoS padding
+        In packed mode the active batch shrinks as rows end, like with packed sequences, so
+        the work is proportional to the number of tokens.
+        """
+        batch_size, length = inputs.shape[:2]
+        masks = masks.view(batch_size, length)
+        order = None
+        if self.packed:
+            batch_sizes, order = packed_batch_sizes(masks)
+            if order is not None:
+                inputs, hidden = inputs[order], hidden[order]
+        else:
+            batch_sizes = [batch_size] * length
+        # input projections of all steps in one matmul
+        input_projs = self.rnn.project_inputs(inputs)
+        outputs = input_projs.new_zeros(batch_size, length, self.hidden_size)
+        for t, step_size in enumerate(batch_sizes):
+            if step_size == 0:
+                break
+            hidden = self.rnn.step(input_projs[:step_size, t], hidden[:step_size])
+            outputs[:step_size, t] = hidden
+
+        if order is not None:
+            outputs = torch_utils.unsort_rows(outputs, order)
+        if not self.packed:
+            # enforce EoS padding
+            outputs.masked_fill_(masks.eq(0).unsqueeze(2), 0.)
         return outputs
 
 
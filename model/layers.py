@@ -84,14 +84,14 @@ class PositionAwareAttention(nn.Module):
         if self.wlinear is not None:
             f_proj = self.wlinear(f.view(-1, self.feature_size)).contiguous().view(
                 batch_size, seq_len, self.attn_size)
-            projs = [x_proj, q_proj, f_proj]
+            projs = x_proj + q_proj + f_proj
         else:
-            projs = [x_proj, q_proj]
-        scores = self.tlinear(torch.tanh(sum(projs)).view(-1, self.attn_size)).view(
+            projs = x_proj + q_proj
+        scores = self.tlinear(torch.tanh(projs).view(-1, self.attn_size)).view(
             batch_size, seq_len)
 
         # mask padding
-        scores.data.masked_fill_(x_mask.data, -float('inf'))
+        scores = scores.masked_fill(x_mask, -float('inf'))
         weights = F.softmax(scores, dim=1)
         # weighted average input vectors
         outputs = weights.unsqueeze(1).bmm(x).squeeze(1)
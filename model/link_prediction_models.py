@@ -1,5 +1,7 @@
 # Copied from https://github.com/TimDettmers/ConvE/blob/master/model.py
 
+from typing import Optional, Tuple
+
 import torch
 from torch.nn import functional as F, Parameter
 from torch.autograd import Variable
@@ -57,7 +59,7 @@ class DistMult(torch.nn.Module):
         self.is_pretrained = False
         self.embedding_dim = args['embedding_dim']
 
-    def forward(self, e1, rel, e2):
+    def forward(self, e1, rel, e2, token_mask: Optional[torch.Tensor] = None):
         # [B, T, E]
         e1_embedded = e1
         rel_embedded = rel
@@ -85,6 +87,8 @@ class ConvE(torch.nn.Module):
         self.stride = args['stride']
         self.padding = args['padding']
         self.embedding_dim = args['embedding_dim']
+        # whether forward can use shared_subject_forward
+        self.shares_subject = self.padding in [0, (0, 0)] and self.stride in [1, (1, 1)]
         self.conv1 = torch.nn.Conv2d(1, self.filter_channels, self.kernel_size,
                                      self.stride, self.padding, bias=args['use_bias'])
         output_width = 2*self.emb_dim1 - self.kernel_size[0] + 1
@@ -103,10 +107,22 @@ class ConvE(torch.nn.Module):
             self.is_pretrained = False
 
 
-    def forward(self, e1, rel, e2):
+    def forward(self, e1, rel, e2, token_mask: Optional[torch.Tensor] = None):
+        """
+        Score the [B, T, E] tokens rel against the [B, 1, E] subject e1 and object e2, giving
+        [B, T, 1] scores. Tokens outside the optional [B, T] token_mask are skipped and scored
+        0 (see shared_subject_forward).
+        """
+        # (a dynamically quantized fc has no weight tensor to split)
+        if self.shares_subject and isinstance(self.fc.weight, torch.Tensor):
+            return self.shared_subject_forward(e1, rel, e2, token_mask)
+        return self.repeated_subject_forward(e1, rel, e2)
+
+    def repeated_subject_forward(self, e1, rel, e2):
+        """ forward stacking a copy of the subject above every token, scoring every token. """
         # e1_embedded= self.emb_e(e1).view(-1, 1, self.emb_dim1, self.emb_dim2)
         # rel_embedded = self.emb_rel(rel).view(-1, 1, self.emb_dim1, self.emb_dim2)
-        batch_size, num_tokens = rel.shape[:2]
+        batch_size, num_tokens = rel.size(0), rel.size(1)
 
         # [B, T, E] --> [B*T, 1, H, W]
         e1_embedded = e1.repeat(1, num_tokens, 1).view(-1, 1, self.emb_dim1, self.emb_dim2)
@@ -135,6 +151,94 @@ class ConvE(torch.nn.Module):
 
         return pred
 
+    def shared_subject_forward(self, e1, rel, e2, token_mask: Optional[torch.Tensor] = None):
+        """
+        forward without stacking a copy of the subject above every token. The conv output rows
+        that only see subject rows are computed once per sentence, with their part of fc, and
+        only the remaining rows (the last k-1 subject rows and the token rows) are convolved per
+        token. Batch norm and dropout act independently on every image row and feature, so this
+        matches repeated_subject_forward in eval mode. In training, batch norm statistics count
+        every subject once per scored token, as if it was repeated, but dropout masks of the
+        subject rows are shared by the tokens of a sentence.
+        """
+        batch_size, num_tokens = rel.size(0), rel.size(1)
+        # conv output rows that only cover subject rows
+        num_subj_rows = self.emb_dim1 - self.kernel_size[0] + 1
+        if token_mask is None:
+            sentence_idx = torch.arange(batch_size, device=rel.device).repeat_interleave(num_tokens)
+            subj_counts = torch.full((batch_size,), num_tokens, dtype=torch.long, device=rel.device)
+            rel = rel.reshape(-1, self.embedding_dim)
+        else:
+            token_mask = token_mask.to(torch.bool)
+            # nonzero is row-major, like the order of rel[token_mask]
+            sentence_idx = token_mask.nonzero()[:, 0]
+            subj_counts = token_mask.sum(1)
+            rel = rel[token_mask]
+
+        subj_images = e1.reshape(batch_size, 1, self.emb_dim1, self.emb_dim2)
+        rel_images = rel.reshape(-1, 1, self.emb_dim1, self.emb_dim2)
+        if self.training:
+            subj_images, rel_images = self.shared_batch_norm('bn0', subj_images, rel_images, subj_counts)
+        else:
+            subj_images, rel_images = self.bn0(subj_images), self.bn0(rel_images)
+        subj_images, rel_images = self.inp_drop(subj_images), self.inp_drop(rel_images)
+        # [B, 1, H, W] --> [B, C, H-k+1, W']
+        subj_features = self.conv1(subj_images)
+        # [N, 1, k-1+H, W] --> [N, C, H, W']
+        token_images = torch.cat([subj_images[:, :, num_subj_rows:][sentence_idx], rel_images], 2)
+        token_features = self.conv1(token_images)
+        if self.training:
+            subj_features, token_features = self.shared_batch_norm('bn1', subj_features, token_features, subj_counts)
+        else:
+            subj_features, token_features = self.bn1(subj_features), self.bn1(token_features)
+        subj_features = self.feature_map_drop(F.relu(subj_features))
+        token_features = self.feature_map_drop(F.relu(token_features))
+
+        # split fc between the subject and token rows of the conv output
+        fc_weight = self.fc.weight.view(self.embedding_dim, self.filter_channels, -1, subj_features.size(3))
+        subj_fc_weight = fc_weight[:, :, :num_subj_rows].reshape(self.embedding_dim, -1)
+        token_fc_weight = fc_weight[:, :, num_subj_rows:].reshape(self.embedding_dim, -1)
+        subj_x = F.linear(subj_features.reshape(batch_size, -1), subj_fc_weight)
+        x = F.linear(token_features.reshape(rel.size(0), -1), token_fc_weight, self.fc.bias)
+        x = F.relu(self.bn2(self.hidden_drop(x + subj_x[sentence_idx])))
+
+        if token_mask is None:
+            x = x.view(batch_size, num_tokens, -1)
+        else:
+            tokens_x = x.new_zeros(batch_size, num_tokens, x.size(1))
+            tokens_x[token_mask] = x
+            x = tokens_x
+        # [B, T, E] x [B, E, 1] --> [B, T, 1]
+        return torch.bmm(x, e2.transpose(2, 1))
+
+    @torch.jit.unused
+    def shared_batch_norm(self, bn_name: str, subj: torch.Tensor, tokens: torch.Tensor,
+                          subj_counts: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Training mode batch norm bn_name of [B, C, *, *] subj and [N, C, *, *] tokens, with the
+        statistics of the batch holding subj_counts copies of every subject row next to the tokens.
+        """
+        bn = getattr(self, bn_name)
+        weights = subj_counts.to(subj.dtype).view(-1, 1, 1, 1)
+        num_values = weights.sum() * subj.size(2) * subj.size(3) + tokens.size(0) * tokens.size(2) * tokens.size(3)
+        mean = ((subj * weights).sum((0, 2, 3)) + tokens.sum((0, 2, 3))) / num_values
+        mean = mean.view(1, -1, 1, 1)
+        var = (((subj - mean) ** 2 * weights).sum((0, 2, 3)) + ((tokens - mean) ** 2).sum((0, 2, 3))) / num_values
+        var = var.view(1, -1, 1, 1)
+        if bn.track_running_stats:
+            with torch.no_grad():
+                bn.num_batches_tracked += 1
+                momentum = bn.momentum if bn.momentum is not None else 1. / float(bn.num_batches_tracked)
+                bn.running_mean.mul_(1 - momentum).add_(momentum * mean.view(-1))
+                # the running variance is unbiased
+                bn.running_var.mul_(1 - momentum).add_(momentum * var.view(-1) * num_values / (num_values - 1))
+        scale = torch.rsqrt(var + bn.eps)
+        shift = -mean * scale
+        if bn.affine:
+            scale = scale * bn.weight.view(1, -1, 1, 1)
+            shift = shift * bn.weight.view(1, -1, 1, 1) + bn.bias.view(1, -1, 1, 1)
+        return subj * scale + shift, tokens * scale + shift
+
     def load_model(self, model_path):
         state_dict = torch.load(model_path)
         relevant_state_dict = dict([(k,v) for k,v in state_dict.items() if 'emb' not in k and k != 'b'])
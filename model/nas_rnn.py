@@ -1,5 +1,6 @@
 import math
 import numpy as np
+from typing import List, Optional
 import torch
 from torch import nn
 from torch.nn import init
@@ -11,7 +12,77 @@ from model.blocks import *
 
 INITRANGE = 0.04
 
+def apply_activation(x, name: str):
+    if name == 'tanh':
+        return torch.tanh(x)
+    elif name == 'relu':
+        return torch.relu(x)
+    elif name == 'sigmoid':
+        return torch.sigmoid(x)
+    elif name == 'identity':
+        return x
+    raise NotImplementedError(name)
+
+class DARTSCell(nn.Module):
+    """
+    A step of a DARTS recurrent cell. Nodes reading the same state are computed as one group,
+    with a single matmul over their concatenated weights and one call per distinct activation.
+    Weights are passed in by DARTSModel, so that the cell can be compiled with torch.jit.script.
+    """
+    def __init__(self, hidden_dim, connections, merge_layers):
+        super(DARTSCell, self).__init__()
+        self.hidden_dim = hidden_dim
+        self.num_states = len(connections) + 1
+        self.merge_layers = [int(i) for i in merge_layers]
+        # groups in order of the state they read, so their input is always computed first
+        self.group_sources = sorted(set(int(source) for _, source in connections))
+        self.group_nodes = [[node for node, (_, source) in enumerate(connections) if source == group_source]
+                            for group_source in self.group_sources]
+        self.group_activations = [[str(connections[node][0]) for node in nodes] for nodes in self.group_nodes]
+        # the activation shared by all nodes of a group, if any
+        self.group_activation = [names[0] if len(set(names)) == 1 else '' for names in self.group_activations]
+
+    def forward(self, input_proj, hidden, h_mask: Optional[torch.Tensor], hidden_weights,
+                group_weights: List[torch.Tensor]):
+        """
+        input_proj : batch_size * 2 hidden_dim, the input half of the initial projection
+        hidden : batch_size * hidden_dim
+        h_mask : batch_size * hidden_dim dropout mask of the states, or None
+        """
+        masked_hidden = hidden if h_mask is None else hidden * h_mask
+        cell_state, hidden_state = torch.split(input_proj + masked_hidden.mm(hidden_weights), self.hidden_dim, dim=-1)
+        initial_state = hidden + cell_state.sigmoid() * (hidden_state.tanh() - hidden)
+
+        states = [initial_state for _ in range(self.num_states)]
+        for group, weights in enumerate(group_weights):
+            input_state = states[self.group_sources[group]]
+            masked_input = input_state if h_mask is None else input_state * h_mask
+            nodes = self.group_nodes[group]
+            # [B, H] x [H, N*2H] --> [B, N, 2, H]
+            joint_state = masked_input.mm(weights).view(-1, len(nodes), 2, self.hidden_dim)
+            cell_state = joint_state[:, :, 0].sigmoid()
+            if self.group_activation[group] != '':
+                hidden_state = apply_activation(joint_state[:, :, 1], self.group_activation[group])
+            else:
+                hidden_state = torch.stack([apply_activation(joint_state[:, i, 1], name)
+                                            for i, name in enumerate(self.group_activations[group])], 1)
+            input_state = input_state.unsqueeze(1)
+            output_states = input_state + cell_state * (hidden_state - input_state)
+            for i, node in enumerate(nodes):
+                states[node + 1] = output_states[:, i]
+
+        output = states[self.merge_layers[0]]
+        for i in self.merge_layers[1:]:
+            output = output + states[i]
+        return output / len(self.merge_layers)
+
 class DARTSModel(nn.Module):
+    """
+    A DARTS recurrent encoder, not yet used by PositionAwareRNN. Besides the embedding sizes,
+    opt holds the architecture (arc_connections, arc_merge_layers), the input and hidden
+    dropout rates (dropout_x, dropout_h), and optionally nas_packed (default True: skip
+    padded steps) and nas_jit (default False: compile the cell with torch.jit.script).
+    """
     def __init__(self, opt):
         super(DARTSModel, self).__init__()
         self.opt = opt
@@ -39,6 +110,12 @@ class DARTSModel(nn.Module):
 
         self.decoder = nn.Linear(self.hidden_dim, opt['num_class'])
 
+        self.cell = DARTSCell(self.hidden_dim, self.connections, self.merge_layers)
+        if opt.get('nas_jit', False):
+            self.cell = torch.jit.script(self.cell)
+        # shrink the active batch as sequences end, like packed sequences
+        self.packed = opt.get('nas_packed', True)
+
     def mask2d(self, B, D, keep_prob):
         m = torch.floor(torch.rand(B, D) + keep_prob) / keep_prob
         m = Variable(m, requires_grad=False)
@@ -48,12 +125,20 @@ class DARTSModel(nn.Module):
 
     def forward(self, inputs, hidden, masks):
         batch_size, token_dim, _ = inputs.shape
-        masks = masks.unsqueeze(2)
         encoded_inputs = self.input_encoder(inputs)
 
         init_hidden, _ = self.zero_state(batch_size)
-        encoded_outputs = self.encode_sequence(encoded_inputs, init_hidden)
-        masked_outputs = encoded_outputs * masks
+        if self.packed:
+            # padded steps are never computed, so their outputs stay zero
+            batch_sizes, order = packed_batch_sizes(masks.view(batch_size, token_dim))
+            if order is not None:
+                encoded_inputs = encoded_inputs[order]
+            masked_outputs = self.encode_sequence(encoded_inputs, init_hidden, batch_sizes)
+            if order is not None:
+                masked_outputs = torch_utils.unsort_rows(masked_outputs, order)
+        else:
+            encoded_outputs = self.encode_sequence(encoded_inputs, init_hidden)
+            masked_outputs = encoded_outputs * masks.unsqueeze(2)
         # aggregated_output = torch.mean(masked_outputs, dim=1)
         # logits = self.decoder(aggregated_output)
 
@@ -68,64 +153,48 @@ class DARTSModel(nn.Module):
         else:
             return h0, c0
 
-    def encode_sequence(self, inputs, hidden):
+    def encode_sequence(self, inputs, hidden, batch_sizes=None):
+        """
+        Encode the [B, T, E] inputs from the [B, H] hidden state. If batch_sizes is given, only
+        the first batch_sizes[t] rows are advanced at step t, and the outputs of the other rows
+        are left at zero.
+        """
         batch_size, sequence_len, input_dim = inputs.shape
-        encoded_steps = []
-        for step in range(sequence_len):
-            input_step = inputs[:, step, :]
-            hidden = self.rnn_pass(input_step, hidden)
-            encoded_steps.append(hidden)
-        encoded_steps = torch.stack(encoded_steps)
-        encoded_steps = torch.transpose(encoded_steps, 0, 1)
-        return encoded_steps#, encoded_steps[-1].unsqueeze(0)
-
-    def _get_activation(self, name):
-      if name == 'tanh':
-        f = F.tanh
-      elif name == 'relu':
-        f = F.relu
-      elif name == 'sigmoid':
-        f = F.sigmoid
-      elif name == 'identity':
-        f = lambda x: x
-      else:
-        raise NotImplementedError
-      return f
+        if batch_sizes is None:
+            batch_sizes = [batch_size] * sequence_len
+        if self.training:
+            # a fresh input dropout mask per timestep
+            x_masks = self.mask2d(batch_size * sequence_len, input_dim, keep_prob=1. - self.dropout_x)
+            inputs = inputs * x_masks.view(batch_size, sequence_len, input_dim)
+        # the input half of the initial projection, for all timesteps in one matmul
+        input_projs = inputs.matmul(self._W0[:self.emb_dim])
+        hidden_weights = self._W0[self.emb_dim:]
+        group_weights = self.group_weights()
+        encoded_steps = input_projs.new_zeros(batch_size, sequence_len, self.hidden_dim)
+        for step, step_size in enumerate(batch_sizes):
+            if step_size == 0:
+                break
+            if self.training:
+                h_mask = self.mask2d(step_size, self.hidden_dim, keep_prob=1. - self.dropout_h)
+            else:
+                h_mask = None
+            hidden = self.cell(input_projs[:step_size, step], hidden[:step_size], h_mask,
+                               hidden_weights, group_weights)
+            encoded_steps[:step_size, step] = hidden
+        return encoded_steps
+
+    def group_weights(self):
+        """ The weights of the nodes of each cell group, concatenated for a single matmul per group. """
+        return [torch.cat([self._Ws[node] for node in nodes], dim=1) for nodes in self.cell.group_nodes]
 
     def rnn_pass(self, input_step, hidden):
+        """ A single step of the cell, see encode_sequence for whole sequences. """
         batch_size, input_dim = input_step.shape
         if self.training:
             x_mask = self.mask2d(batch_size, input_dim, keep_prob=1. - self.dropout_x)
-            h_mask = self.mask2d(batch_size, input_dim, keep_prob=1. - self.dropout_h)
+            h_mask = self.mask2d(batch_size, self.hidden_dim, keep_prob=1. - self.dropout_h)
+            input_step = input_step * x_mask
         else:
-            x_mask = h_mask = None
-        initial_state = self.compute_initial_state(input_step, hidden, x_mask, h_mask)
-        past_states = [initial_state]
-
-        for layer_idx, (activation_name, input_connection) in enumerate(self.connections):
-            input_state = past_states[input_connection]
-            if self.training:
-                joint_state = (input_state * h_mask).mm(self._Ws[layer_idx])
-            else:
-                joint_state = input_state.mm(self._Ws[layer_idx])
-            cell_state, hidden_state = torch.split(joint_state, self.hidden_dim, dim=-1)
-            cell_state = cell_state.sigmoid()
-            activation = self._get_activation(activation_name)
-            hidden_state = activation(hidden_state)
-            output_state = input_state + cell_state * (hidden_state - input_state)
-            past_states += [output_state]
-
-        rnn_output = torch.mean(torch.stack([past_states[i] for i in self.merge_layers], -1), -1)
-        return rnn_output
-
-    def compute_initial_state(self, init_input, hidden, x_mask, h_mask):
-        if self.training:
-            input_state = torch.cat([init_input * x_mask, hidden * h_mask], dim=-1)
-        else:
-            input_state = torch.cat([init_input, hidden], dim=-1)
-        cell_state, hidden_state = torch.split(input_state.mm(self._W0), self.hidden_dim, dim=-1)
-        cell_state = cell_state.sigmoid()
-        hidden_state = hidden_state.tanh()
-        hidden_state = hidden + cell_state * (hidden_state - hidden)
-        return hidden_state
-
+            h_mask = None
+        input_proj = input_step.mm(self._W0[:self.emb_dim])
+        return self.cell(input_proj, hidden, h_mask, self._W0[self.emb_dim:], self.group_weights())
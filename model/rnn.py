@@ -2,6 +2,7 @@
 A rnn model for relation extraction, written in pytorch.
 """
 import math
+from typing import List, Final
 import numpy as np
 import torch
 from torch import nn
@@ -10,7 +11,6 @@ import torch.nn.functional as F
 
 from utils import constant, torch_utils
 from model import layers
-from model.nas_rnn import DARTSModel
 from model.blocks import *
 from model.cpg_modules import ContextualParameterGenerator
 from model.link_prediction_models import *
@@ -28,6 +28,19 @@ def choose_fact_checker(params):
         raise ValueError('Only, {distmult, conve, and complex}  are supported')
     return fact_checker
 
+def get_autocast_dtype(opt):
+    """ The autocast dtype of opt['precision'] (fp32, fp16 or bf16), or None for full precision. """
+    precision = opt.get('precision', 'fp32')
+    if precision == 'fp32':
+        return None
+    elif precision == 'bf16':
+        return torch.bfloat16
+    elif precision == 'fp16':
+        if not opt['cuda']:
+            raise ValueError('fp16 autocast requires cuda, use bf16 on cpu')
+        return torch.float16
+    raise ValueError('Only, {fp32, fp16, and bf16} precisions are supported')
+
 class RelationModel(object):
     """ A wrapper class for the training and evaluation of models. """
     def __init__(self, opt, emb_matrix=None):
@@ -39,24 +52,58 @@ class RelationModel(object):
             self.model.cuda()
             self.criterion.cuda()
         self.optimizer = torch_utils.get_optimizer(opt['optim'], self.parameters, opt['lr'])
+        # in distributed training, updates run through a DistributedDataParallel wrapper that starts
+        # every rank from the weights of rank 0 and averages gradients over ranks during backward.
+        # Clipping and the optimizer then see the same gradients on every rank, so they stay in sync.
+        self.train_model = self.model
+        if torch_utils.is_distributed():
+            self.train_model = nn.parallel.DistributedDataParallel(
+                self.model, find_unused_parameters=opt.get('find_unused_parameters', True))
+        # optional mixed precision: autocast the forward pass, and scale the loss for fp16 on cuda
+        self.autocast_dtype = get_autocast_dtype(opt)
+        self.scaler = torch.amp.GradScaler('cuda', enabled=self.autocast_dtype == torch.float16)
 
         self.reg_params = opt.get('reg_params', None)
         if self.reg_params is not None and self.reg_params['type'] == 'fact_checking':
 
             self.fact_checker = choose_fact_checker(self.reg_params)
 
+        # checkpoints of quantized models hold packed int8 weights, so quantize before loading
+        if opt.get('quantized', False):
+            self.quantize()
+
+    def quantize(self):
+        """
+        Dynamically quantize the weights of the LSTM and all linear layers (output layer,
+        attention projections, fact checker) to int8. Quantized models only run inference on cpu.
+        """
+        assert not self.opt['cuda'], "Quantized models only run on cpu."
+        self.model = torch.ao.quantization.quantize_dynamic(self.model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+        self.opt['quantized'] = True
+        self.opt['precision'] = 'fp32'
+        self.autocast_dtype = None
+
     def maybe_place_batch_on_cuda(self, batch):
+        """ Split off the labels and original order of batch. batch itself is left unchanged, so it can be reused. """
         base_batch = batch['base'][:7]
         labels = batch['base'][7]
         orig_idx = batch['base'][8]
+        supplemental = dict(batch['supplemental'])
         if self.opt['cuda']:
-            base_batch = [component.cuda() for component in base_batch]
-            labels = labels.cuda()
-            for name, data in batch['supplemental'].items():
-                batch['supplemental'][name] = [component.cuda() for component in data]
+            base_batch = [component.cuda(non_blocking=True) for component in base_batch]
+            labels = labels.cuda(non_blocking=True)
+            for name, data in supplemental.items():
+                supplemental[name] = [component.cuda(non_blocking=True) for component in data]
+
+        inputs = dict(batch)
+        inputs['base'] = base_batch
+        inputs['supplemental'] = supplemental
+        return inputs, labels, orig_idx
 
-        batch['base'] = base_batch
-        return batch, labels, orig_idx
+    def autocast(self):
+        """ Autocast context for the forward pass, a no-op in full precision. """
+        device_type = 'cuda' if self.opt['cuda'] else 'cpu'
+        return torch.autocast(device_type, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None)
 
     def apply_fact_checking_regularization(self, inputs, sentence_encs, token_encs):
         subj_masks, obj_masks = inputs['supplemental']['entity_masks']
@@ -84,27 +131,38 @@ class RelationModel(object):
         return - closeness
 
 
-    def update(self, batch):
-        """ Run a step of forward and backward model update. """
+    def update(self, batch, with_predictions=False):
+        """
+        Run a step of forward and backward model update. If with_predictions is True, also
+        return the predictions and gold labels of the batch (in batch order) for online metrics.
+        """
+        assert not self.opt.get('quantized', False), "Quantized models can only be used for inference."
         inputs, labels, _ = self.maybe_place_batch_on_cuda(batch)
         # step forward
         self.model.train()
         self.optimizer.zero_grad()
-        logits, sentence_encs, token_encs = self.model(inputs)
-        loss = self.criterion(logits, labels)
+        with self.autocast():
+            logits, sentence_encs, token_encs = self.train_model(inputs)
+            loss = self.criterion(logits.float(), labels)
 
-        if self.reg_params is not None and self.reg_params['type'] == 'fact_checking':
-            regularization_measure = self.apply_fact_checking_regularization(inputs=inputs,
-                                                                             sentence_encs=sentence_encs,
-                                                                             token_encs=token_encs)
-            loss += self.reg_params['lambda'] * regularization_measure.sum()
+            if self.reg_params is not None and self.reg_params['type'] == 'fact_checking':
+                regularization_measure = self.apply_fact_checking_regularization(inputs=inputs,
+                                                                                 sentence_encs=sentence_encs,
+                                                                                 token_encs=token_encs)
+                loss += self.reg_params['lambda'] * regularization_measure.float().sum()
 
 
-        # backward
-        loss.backward()
+        # backward, with loss scaling if enabled. Gradients are unscaled before clipping,
+        # and the step is skipped if they overflowed.
+        self.scaler.scale(loss).backward()
+        self.scaler.unscale_(self.optimizer)
         torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.opt['max_grad_norm'])
-        self.optimizer.step()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
         loss_val = loss.data.item()
+        if with_predictions:
+            predictions = logits.detach().argmax(dim=1).cpu().numpy()
+            return loss_val, predictions, labels.cpu().numpy()
         return loss_val
 
     def predict(self, batch, unsort=True):
@@ -112,14 +170,37 @@ class RelationModel(object):
         inputs, labels, orig_idx = self.maybe_place_batch_on_cuda(batch)
         # forward
         self.model.eval()
-        logits, _, _ = self.model(inputs)
-        loss = self.criterion(logits, labels)
-        probs = F.softmax(logits, dim=1).data.cpu().numpy().tolist()
-        predictions = np.argmax(logits.data.cpu().numpy(), axis=1).tolist()
-        if unsort:
-            _, predictions, probs = [list(t) for t in zip(*sorted(zip(orig_idx,\
-                    predictions, probs)))]
-        return predictions, probs, loss.data.item()
+        with torch.no_grad(), self.autocast():
+            logits, _, _ = self.model(inputs)
+            logits = logits.float()
+            loss = self.criterion(logits, labels)
+            probs = F.softmax(logits, dim=1)
+            if unsort:
+                probs = torch_utils.unsort_rows(probs, orig_idx)
+        probs = probs.cpu().numpy()
+        predictions = np.argmax(probs, axis=1).tolist()
+        return predictions, probs.tolist(), loss.item()
+
+    def infer(self, batch, unsort=True, with_loss=False):
+        """
+        Run forward prediction without gradient tracking. Returns predictions and class
+        probabilities as numpy arrays, and the loss if with_loss is True. If unsort is True,
+        recover the original order of the batch.
+        """
+        inputs, labels, orig_idx = self.maybe_place_batch_on_cuda(batch)
+        self.model.eval()
+        with torch.no_grad(), self.autocast():
+            logits, _, _ = self.model(inputs)
+            logits = logits.float()
+            probs = F.softmax(logits, dim=1)
+            if unsort:
+                probs = torch_utils.unsort_rows(probs, orig_idx)
+            if with_loss:
+                loss = self.criterion(logits, labels).item()
+        probs = probs.cpu().numpy()
+        if with_loss:
+            return np.argmax(probs, axis=1), probs, loss
+        return np.argmax(probs, axis=1), probs
 
     def update_lr(self, new_lr):
         torch_utils.change_lr(self.optimizer, new_lr)
@@ -137,13 +218,17 @@ class RelationModel(object):
             print("[Warning: Saving failed... continuing anyway.]")
 
     def load(self, filename):
+        # not weights only: quantized checkpoints hold packed params
         try:
-            checkpoint = torch.load(filename)
+            checkpoint = torch.load(filename, map_location=None if self.opt['cuda'] else 'cpu', weights_only=False)
         except BaseException:
             print("Cannot load model from {}".format(filename))
-            exit()
+            raise
         self.model.load_state_dict(checkpoint['model'])
+        # keep the device this model was built for
+        cuda = self.opt['cuda']
         self.opt = checkpoint['config']
+        self.opt['cuda'] = cuda
 
 class PositionAwareRNN(nn.Module):
     """ A sequence model for relation extraction. """
@@ -197,15 +282,14 @@ class PositionAwareRNN(nn.Module):
         self.opt = opt
         self.topn = float(self.opt.get('topn', 1e10))
         self.use_cuda = opt['cuda']
-        self.emb_matrix = emb_matrix
-        self.init_weights()
+        self.init_weights(emb_matrix)
 
-    def init_weights(self):
-        if self.emb_matrix is None:
+    def init_weights(self, emb_matrix=None):
+        if emb_matrix is None:
             self.emb.weight.data[1:,:].uniform_(-1.0, 1.0) # keep padding dimension to be 0
         else:
-            self.emb_matrix = torch.from_numpy(self.emb_matrix)
-            self.emb.weight.data[:-2].copy_(self.emb_matrix)
+            # single copy from the (possibly memory-mapped) matrix into the weights
+            self.emb.weight.data[:-2].numpy()[:] = emb_matrix
 
         if self.opt['pos_dim'] > 0:
             self.pos_emb.weight.data[1:,:].uniform_(-1.0, 1.0)
@@ -245,7 +329,7 @@ class PositionAwareRNN(nn.Module):
         words, masks, pos, ner, deprel, subj_pos, obj_pos = base_inputs
         if self.opt['fact_checking_attn']:
             subj_masks, obj_masks = inputs['supplemental']['entity_masks']
-        seq_lens = list(masks.data.eq(constant.PAD_ID).long().sum(1).squeeze())
+        seq_lens = masks.data.eq(constant.PAD_ID).long().sum(1).tolist()
         batch_size = words.size()[0]
         
         # embedding lookup
@@ -295,7 +379,8 @@ class PositionAwareRNN(nn.Module):
                 subj_outputs = self.subj_encoder(subj_outputs)
                 obj_outputs = self.obj_encoder(obj_outputs)
 
-            representation_relevances = self.fact_checker(subj_outputs, outputs, obj_outputs)
+            representation_relevances = self.fact_checker(subj_outputs, outputs, obj_outputs,
+                                                          token_mask=masks.eq(constant.PAD_ID))
             # remove subject and object representations
             masked_elements = non_entity_masks.view(batch_size, -1, 1)
             representation_relevances = representation_relevances + (masked_elements + 1e-45).log()
@@ -306,3 +391,139 @@ class PositionAwareRNN(nn.Module):
             final_hidden = hidden
         logits = self.linear(final_hidden)
         return logits, final_hidden, outputs
+
+class ExportableRNN(nn.Module):
+    """
+    Inference only view of a trained PositionAwareRNN with a flat tensor signature, which can
+    be compiled with torch.jit.script, and so exported to TorchScript or ONNX with dynamic batch
+    and sequence sizes. Shares the weights of the wrapped model, and resolves the branches on
+    opt once at construction.
+    """
+    use_pos: Final[bool]
+    use_ner: Final[bool]
+    use_attn: Final[bool]
+    use_fact_checking: Final[bool]
+    encode_fact_check_inputs: Final[bool]
+    shared_subject: Final[bool]
+    num_layers: Final[int]
+    num_directions: Final[int]
+
+    def __init__(self, model):
+        super(ExportableRNN, self).__init__()
+        opt = model.opt
+        self.emb = model.emb
+        self.use_pos = opt['pos_dim'] > 0
+        self.use_ner = opt['ner_dim'] > 0
+        if self.use_pos:
+            self.pos_emb = model.pos_emb
+        if self.use_ner:
+            self.ner_emb = model.ner_emb
+        # registered for the parameters, as the weights are run with torch.lstm directly
+        self.rnn = model.rnn
+        self.num_layers = model.rnn.num_layers
+        self.num_directions = 2 if model.rnn.bidirectional else 1
+        self.hidden_size = model.rnn.hidden_size
+        self.rnn_bias = model.rnn.bias
+        # weights of every layer and direction, in the order of nn.LSTM.all_weights
+        self.rnn_weights: List[List[torch.Tensor]] = [list(weights) for weights in model.rnn.all_weights]
+        self.linear = model.linear
+
+        self.use_attn = bool(opt['attn'])
+        self.use_fact_checking = not self.use_attn and bool(opt['fact_checking_attn'])
+        self.encode_fact_check_inputs = False
+        self.shared_subject = False
+        if self.use_attn:
+            self.attn_layer = model.attn_layer
+            self.pe_emb = model.pe_emb
+        elif self.use_fact_checking:
+            self.fact_checker = model.fact_checker
+            # ConvE is exported through its eval mode path, which convolves every subject once
+            self.shared_subject = isinstance(model.fact_checker, ConvE)
+            assert not self.shared_subject or model.fact_checker.shares_subject, \
+                "Only ConvE with no padding and stride 1 can be exported."
+            self.encode_fact_check_inputs = model.encode_fact_check_inputs
+            if self.encode_fact_check_inputs:
+                self.token_encoder = model.token_encoder
+                self.subj_encoder = model.subj_encoder
+                self.obj_encoder = model.obj_encoder
+
+    def encode(self, inputs, lengths):
+        """
+        Run the LSTM over right padded inputs without packing, one layer and direction at a time.
+        Reverse directions read every sentence reversed within its length, so padding never
+        enters their state. Returns the outputs (zero past every length) and the final hidden
+        state of the top layer, as pad_packed_sequence and ht[-1] give them.
+        """
+        batch_size = inputs.size(0)
+        positions = torch.arange(inputs.size(1), device=inputs.device).unsqueeze(0)
+        valid = positions < lengths.unsqueeze(1)
+        # reverses the tokens of every sentence, leaving padding in place
+        reverse_idx = torch.where(valid, lengths.unsqueeze(1) - 1 - positions, positions).unsqueeze(2)
+        last_idx = (lengths - 1).view(batch_size, 1, 1)
+
+        layer_inputs = inputs
+        hidden = inputs.new_zeros(batch_size, self.hidden_size)
+        for layer in range(self.num_layers):
+            outputs: List[torch.Tensor] = []
+            for direction in range(self.num_directions):
+                x = layer_inputs
+                if direction == 1:
+                    x = x.gather(1, reverse_idx.expand(-1, -1, x.size(2)))
+                h0 = x.new_zeros(1, batch_size, self.hidden_size)
+                output, _, _ = torch.lstm(x, [h0, h0], self.rnn_weights[layer * self.num_directions + direction],
+                                          self.rnn_bias, 1, 0., False, False, True)
+                # the state after the last token, before any padding
+                hidden = output.gather(1, last_idx.expand(-1, -1, output.size(2))).squeeze(1)
+                if direction == 1:
+                    output = output.gather(1, reverse_idx.expand(-1, -1, output.size(2)))
+                outputs.append(output)
+            layer_inputs = torch.cat(outputs, dim=2)
+        outputs = layer_inputs.masked_fill(~valid.unsqueeze(2), 0.)
+        return outputs, hidden
+
+    def forward(self, words, pos, ner, subj_pos, obj_pos, lengths):
+        """
+        words, pos, ner, subj_pos, obj_pos : batch_size * seq_len, padded with PAD_ID
+        lengths : batch_size, the int64 sentence lengths, in any order
+        Returns the class probabilities, batch_size * num_class.
+        """
+        inputs = [self.emb(words)]
+        if self.use_pos:
+            inputs.append(self.pos_emb(pos))
+        if self.use_ner:
+            inputs.append(self.ner_emb(ner))
+        inputs = torch.cat(inputs, dim=2)
+
+        lengths = lengths.to(words.device)
+        outputs, hidden = self.encode(inputs, lengths)
+        masks = torch.arange(words.size(1), device=words.device).unsqueeze(0) >= lengths.unsqueeze(1)
+
+        if self.use_attn:
+            subj_pe_inputs = self.pe_emb(subj_pos + constant.MAX_LEN)
+            obj_pe_inputs = self.pe_emb(obj_pos + constant.MAX_LEN)
+            pe_features = torch.cat((subj_pe_inputs, obj_pe_inputs), dim=2)
+            final_hidden = self.attn_layer(outputs, masks, hidden, pe_features)
+        elif self.use_fact_checking:
+            # entity tokens are the non padding ones at relative position 0
+            subj_masks = subj_pos.eq(0) & ~masks
+            obj_masks = obj_pos.eq(0) & ~masks
+            non_entity_masks = ~(masks | subj_masks | obj_masks)
+            subj_outputs = outputs.masked_fill(~subj_masks.unsqueeze(2), float('-inf')).max(1, keepdim=True)[0]
+            obj_outputs = outputs.masked_fill(~obj_masks.unsqueeze(2), float('-inf')).max(1, keepdim=True)[0]
+            if self.encode_fact_check_inputs:
+                outputs = self.token_encoder(outputs)
+                subj_outputs = self.subj_encoder(subj_outputs)
+                obj_outputs = self.obj_encoder(obj_outputs)
+            # all tokens are scored, as skipping padding needs data dependent shapes
+            if self.shared_subject:
+                representation_relevances = self.fact_checker.shared_subject_forward(subj_outputs, outputs, obj_outputs)
+            else:
+                representation_relevances = self.fact_checker(subj_outputs, outputs, obj_outputs)
+            representation_relevances = representation_relevances + \
+                (non_entity_masks.unsqueeze(2).float() + 1e-45).log()
+            indicator_weights = F.softmax(representation_relevances, dim=1)
+            final_hidden = (indicator_weights * outputs).sum(dim=1)
+        else:
+            final_hidden = hidden
+        logits = self.linear(final_hidden)
+        return F.softmax(logits, dim=1)
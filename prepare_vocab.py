@@ -1,8 +1,6 @@
 """
 Prepare vocabulary and initial word vectors.
 """
-import json
-import pickle
 import argparse
 import numpy as np
 from collections import Counter
@@ -18,6 +16,10 @@ def parse_args():
     parser.add_argument('--wv_dim', type=int, default=300, help='GloVe vector dimension.')
     parser.add_argument('--min_freq', type=int, default=0, help='If > 0, use min_freq as the cutoff.')
     parser.add_argument('--lower', action='store_true', help='If specified, lowercase all words.')
+    parser.add_argument('--num_workers', type=int, default=1, help='Processes used to parse the GloVe file.')
+    parser.add_argument('--no_glove_cache', action='store_true',
+                        help='If specified, do not build or use the binary cache of the GloVe file.')
+    parser.add_argument('--glove_cache_dir', default='', help='Directory of the GloVe binary cache; the GloVe directory by default.')
     
     args = parser.parse_args()
     return args
@@ -34,25 +36,26 @@ def main():
 
     # output files
     helper.ensure_dir(args.vocab_dir)
-    vocab_file = args.vocab_dir + '/vocab.pkl'
+    vocab_file = args.vocab_dir + '/vocab.txt'
     emb_file = args.vocab_dir + '/embedding.npy'
 
     # load files
     print("loading files...")
-    train_tokens = load_tokens(train_file)
-    dev_tokens = load_tokens(dev_file)
-    test_tokens = load_tokens(test_file)
-    if args.lower:
-        train_tokens, dev_tokens, test_tokens = [[t.lower() for t in tokens] for tokens in\
-                (train_tokens, dev_tokens, test_tokens)]
+    train_tokens = load_tokens(train_file, args.lower)
+    dev_tokens = load_tokens(dev_file, args.lower)
+    test_tokens = load_tokens(test_file, args.lower)
 
     # load glove
     print("loading glove...")
-    glove_vocab = vocab.load_glove_vocab(wv_file, wv_dim)
-    print("{} words loaded from glove.".format(len(glove_vocab)))
+    # only vectors of train words and special tokens can end up in the embeddings
+    wanted_words = set(train_tokens).union(constant.VOCAB_PREFIX, entity_masks())
+    glove_vectors = vocab.load_glove(wv_file, wv_dim, wanted_words, num_workers=args.num_workers,
+                                     use_cache=not args.no_glove_cache,
+                                     cache_dir=args.glove_cache_dir if len(args.glove_cache_dir) > 0 else None)
+    print("{} train words found in glove.".format(len(glove_vectors)))
     
     print("building vocab...")
-    v = build_vocab(train_tokens, glove_vocab, args.min_freq)
+    v = build_vocab(train_tokens, glove_vectors, args.min_freq)
 
     print("calculating oov...")
     datasets = {'train': train_tokens, 'dev': dev_tokens, 'test': test_tokens}
@@ -61,27 +64,29 @@ def main():
         print("{} oov: {}/{} ({:.2f}%)".format(dname, oov, total, oov*100.0/total))
     
     print("building embeddings...")
-    embedding = vocab.build_embedding(wv_file, v, wv_dim)
+    embedding = vocab.build_embedding(glove_vectors, v, wv_dim)
     print("embedding size: {} x {}".format(*embedding.shape))
 
     print("dumping to files...")
-    with open(vocab_file, 'wb') as outfile:
-        pickle.dump(v, outfile)
+    vocab.save_vocab(v, vocab_file)
     np.save(emb_file, embedding)
     print("all done.")
 
-def load_tokens(filename):
-    with open(filename) as infile:
-        data = json.load(infile)
-        tokens = []
-        for d in data:
-            tokens += d['token']
-    print("{} tokens from {} examples loaded from {}.".format(len(tokens), len(data), filename))
-    return tokens
+def load_tokens(filename, lower=False):
+    """ Count tokens while streaming examples from a JSON or JSON-lines file. """
+    counter = Counter()
+    num_examples = 0
+    for d in helper.iter_json(filename):
+        tokens = d['token']
+        if lower:
+            tokens = [t.lower() for t in tokens]
+        counter.update(tokens)
+        num_examples += 1
+    print("{} tokens from {} examples loaded from {}.".format(sum(counter.values()), num_examples, filename))
+    return counter
 
-def build_vocab(tokens, glove_vocab, min_freq):
-    """ build vocab from tokens and glove words. """
-    counter = Counter(t for t in tokens)
+def build_vocab(counter, glove_vocab, min_freq):
+    """ build vocab from token counts and glove words. """
     # if min_freq > 0, use min_freq, otherwise keep all glove words
     if min_freq > 0:
         v = sorted([t for t in counter if counter.get(t) >= min_freq], key=counter.get, reverse=True)
@@ -92,8 +97,7 @@ def build_vocab(tokens, glove_vocab, min_freq):
     print("vocab built with {}/{} words.".format(len(v), len(counter)))
     return v
 
-def count_oov(tokens, vocab):
-    c = Counter(t for t in tokens)
+def count_oov(c, vocab):
     total = sum(c.values())
     matched = sum(c[t] for t in vocab)
     return total, total-matched
@@ -0,0 +1,87 @@
+"""
+Export a dynamically quantized (int8 weights) version of a saved model for CPU inference,
+and compare its accuracy and latency with the fp32 model.
+
+The quantized checkpoint is loaded like any other, e.g.
+    python eval.py saved_models/00 --model quantized_model.pt --dataset dev
+"""
+
+import os
+import time
+import argparse
+import numpy as np
+import torch
+
+from data.loader import DataLoader
+from model.rnn import RelationModel
+from utils import torch_utils, scorer, constant, helper
+from utils.vocab import Vocab, vocab_file as vocab_path
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Quantize a relation extraction model.')
+    parser.add_argument('model_dir', type=str, help='Directory of the model.')
+    parser.add_argument('--model', type=str, default='best_model.pt', help='Name of the model file.')
+    parser.add_argument('--out', type=str, default='quantized_model.pt', help='Name of the quantized model file.')
+    parser.add_argument('--dataset', type=str, default='dev', help='Compare on dev or test.')
+    parser.add_argument('--threads', type=int, default=0, help='Torch intra-op threads; 0 keeps the default.')
+    args = parser.parse_args()
+    return args
+
+def benchmark(model, data_batch):
+    """ Returns precision, recall, F1 and per batch latency statistics of model on data_batch. """
+    predictions = []
+    latencies = []
+    for batch in data_batch:
+        start_time = time.perf_counter()
+        preds, _ = model.infer(batch)
+        latencies.append(time.perf_counter() - start_time)
+        predictions += preds.tolist()
+    p, r, f1 = scorer.score_ids(data_batch.gold_ids(), predictions, constant.ID_TO_LABEL)
+    latencies = np.array(latencies) * 1000.
+    return {'precision': p, 'recall': r, 'f1': f1,
+            'ms_per_batch': float(latencies.mean()),
+            'p95_ms_per_batch': float(np.percentile(latencies, 95)),
+            'examples_per_sec': data_batch.num_examples / (latencies.sum() / 1000.)}
+
+def main():
+    args = parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    model_file = os.path.join(args.model_dir, args.model)
+    print("Loading model from {}".format(model_file))
+    opt = torch_utils.load_config(model_file)
+    opt['cuda'] = False
+    opt['precision'] = 'fp32'
+    model = RelationModel(opt)
+    model.load(model_file)
+
+    vocab = Vocab(vocab_path(args.model_dir), load=True)
+    assert opt['vocab_size'] == vocab.size, "Vocab size must match that in the saved model."
+    data_file = opt['data_dir'] + '/{}.json'.format(args.dataset)
+    data_batch = DataLoader(data_file, opt['batch_size'], opt, vocab, evaluation=True)
+
+    print("Evaluating fp32 model on {}...".format(args.dataset))
+    report = {'fp32': benchmark(model, data_batch)}
+    report['fp32']['file_mb'] = os.path.getsize(model_file) / 2 ** 20
+
+    print("Quantizing...")
+    model.quantize()
+    out_file = os.path.join(args.model_dir, args.out)
+    model.save(out_file, epoch=None)
+
+    print("Evaluating int8 model on {}...".format(args.dataset))
+    report['int8'] = benchmark(model, data_batch)
+    report['int8']['file_mb'] = os.path.getsize(out_file) / 2 ** 20
+
+    print('{:<8}'.format('model') + ''.join('{:>18}'.format(k) for k in report['fp32']))
+    for name, metrics in report.items():
+        print('{:<8}'.format(name) + ''.join('{:>18.4f}'.format(v) for v in metrics.values()))
+    print("F1 change: {:+.4f} | speedup: {:.2f}x".format(report['int8']['f1'] - report['fp32']['f1'],
+          report['fp32']['ms_per_batch'] / report['int8']['ms_per_batch']))
+    report_file = os.path.join(args.model_dir, 'quantization_report_{}.json'.format(args.dataset))
+    helper.save_config(report, report_file, verbose=False)
+    print("Report saved to {}.".format(report_file))
+
+if __name__ == '__main__':
+    main()
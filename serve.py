@@ -0,0 +1,213 @@
+"""
+Serve a trained model over a local HTTP endpoint (TCP or Unix socket), micro-batching
+concurrent requests.
+
+POST /predict with a TACRED-format example dict, or a list of them, as JSON body.
+The response lists, per example, the predicted relation and the class probabilities
+(indexed as in GET /labels).
+"""
+
+import os
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+import socketserver
+import torch
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from data.loader import ExampleBatcher
+from model.rnn import RelationModel
+from utils import torch_utils, constant
+from utils.vocab import Vocab, vocab_file as vocab_path
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve a relation extraction model.')
+    parser.add_argument('model_dir', type=str, help='Directory of the model.')
+    parser.add_argument('--model', type=str, default='best_model.pt', help='Name of the model file.')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix_socket', type=str, default='', help='Listen on this Unix socket instead of TCP.')
+    parser.add_argument('--max_batch_size', type=int, default=64, help='Max examples per model call.')
+    parser.add_argument('--max_wait_ms', type=float, default=5., help='Max time to wait for a batch to fill up.')
+    parser.add_argument('--threads', type=int, default=0, help='Torch intra-op threads; 0 keeps the default.')
+    parser.add_argument('--precision', type=str, default='fp32', help='Inference precision: fp32 or bf16.')
+    args = parser.parse_args()
+    return args
+
+class MicroBatcher(object):
+    """
+    Collect examples from concurrent requests into batches of at most max_batch_size,
+    waiting at most max_wait seconds for a batch to fill, and run them through the
+    model on a single worker thread.
+    """
+    def __init__(self, model, batcher, max_batch_size, max_wait):
+        self.model = model
+        self.batcher = batcher
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, examples):
+        """
+        Validate and preprocess examples on the calling thread, raising ValueError if any is
+        malformed, and queue them. Returns a future of their (predictions, probs).
+        """
+        processed = self.batcher.preprocess_examples(examples)
+        future = Future()
+        self.requests.put((processed, future))
+        return future
+
+    def next_batch(self):
+        pending = [self.requests.get()]
+        num_examples = len(pending[0][0])
+        deadline = time.time() + self.max_wait
+        while num_examples < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            pending.append(request)
+            num_examples += len(request[0])
+        return pending
+
+    def run(self):
+        while True:
+            pending = self.next_batch()
+            examples = [e for request_examples, _ in pending for e in request_examples]
+            try:
+                predictions, probs = self.predict(examples)
+            except Exception:
+                # retry one request at a time, so that a failure only reaches its own caller
+                for request_examples, future in pending:
+                    try:
+                        future.set_result(self.predict(request_examples))
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+            start = 0
+            for request_examples, future in pending:
+                end = start + len(request_examples)
+                future.set_result((predictions[start:end], probs[start:end]))
+                start = end
+
+    def predict(self, examples):
+        predictions, probs = [], []
+        # a single large request may exceed the batch size
+        for start in range(0, len(examples), self.max_batch_size):
+            batch = self.batcher.batch(examples[start: start + self.max_batch_size])
+            batch_predictions, batch_probs = self.model.infer(batch)
+            predictions += batch_predictions.tolist()
+            probs += batch_probs.tolist()
+        return predictions, probs
+
+class RequestHandler(BaseHTTPRequestHandler):
+    micro_batcher = None
+    id2label = None
+
+    def do_GET(self):
+        if self.path == '/labels':
+            self.send_json(200, self.id2label)
+        elif self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            examples = json.loads(self.rfile.read(length).decode('utf8'))
+        except ValueError as e:
+            self.send_json(400, {'error': 'Invalid JSON: {}'.format(e)})
+            return
+        if isinstance(examples, dict):
+            examples = [examples]
+        if not isinstance(examples, list):
+            self.send_json(400, {'error': 'Expected an example or a list of examples.'})
+            return
+        try:
+            future = self.micro_batcher.submit(examples)
+        except ValueError as e:
+            self.send_json(400, {'error': 'Malformed example: {}'.format(e)})
+            return
+        try:
+            predictions, probs = future.result()
+        except Exception as e:
+            self.send_json(500, {'error': 'Prediction failed: {}'.format(repr(e))})
+            return
+        results = [{'relation': self.id2label[p], 'probs': prob}
+                   for p, prob in zip(predictions, probs)]
+        self.send_json(200, results)
+
+    def send_json(self, code, content):
+        body = json.dumps(content).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # per-request logging costs latency
+        pass
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = self.server_port = ''
+
+    def get_request(self):
+        request, _ = super(UnixHTTPServer, self).get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('unix', 0)
+
+def main():
+    args = parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    # load model, always on CPU
+    model_file = args.model_dir + '/' + args.model
+    print("Loading model from {}".format(model_file))
+    opt = torch_utils.load_config(model_file)
+    opt['cuda'] = False
+    opt['precision'] = args.precision
+    model = RelationModel(opt)
+    model.load(model_file)
+
+    vocab = Vocab(vocab_path(args.model_dir), load=True)
+    assert opt['vocab_size'] == vocab.size, "Vocab size must match that in the saved model."
+
+    RequestHandler.id2label = constant.ID_TO_LABEL
+    RequestHandler.micro_batcher = MicroBatcher(model, ExampleBatcher(model.opt, vocab),
+                                                args.max_batch_size, args.max_wait_ms / 1000.)
+
+    if len(args.unix_socket) > 0:
+        server = UnixHTTPServer(args.unix_socket, RequestHandler)
+        print("Serving on unix socket {}".format(args.unix_socket))
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+        print("Serving on http://{}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""
+Shared fixtures: a vocab over the bundled TACRED sample and the options of a tiny model.
+"""
+
+import os
+import json
+import pytest
+
+from utils import constant
+from utils.vocab import Vocab, save_vocab
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dataset', 'tacred')
+
+def tiny_opt(vocab, **overrides):
+    opt = {'cuda': False, 'cpu': True, 'vocab_size': vocab.size, 'emb_dim': 10, 'pos_dim': 5, 'ner_dim': 5,
+           'hidden_dim': 8, 'encoding_dim': 8, 'bidirectional_encoding': False, 'num_layers': 2, 'dropout': 0.5,
+           'word_dropout': 0., 'topn': 1e10, 'lower': False, 'lr': 1.0, 'optim': 'sgd', 'max_grad_norm': 5.0,
+           'batch_size': 8, 'attn': True, 'attn_dim': 6, 'pe_dim': 4, 'fact_checking_attn': False,
+           'reg_params': None, 'remove_entity_types': False, 'cache_dir': 'None',
+           'num_class': len(constant.LABEL_TO_ID), 'precision': 'fp32'}
+    opt.update(overrides)
+    return opt
+
+@pytest.fixture
+def vocab(tmp_path):
+    """ A vocab of every word in the dev split. """
+    with open(os.path.join(DATA_DIR, 'dev.json')) as infile:
+        words = sorted(set(w for d in json.load(infile) for w in d['token']))
+    vocab_file = str(tmp_path / 'vocab.txt')
+    save_vocab(constant.VOCAB_PREFIX + words, vocab_file)
+    return Vocab(vocab_file, load=True)
@@ -0,0 +1,56 @@
+"""
+ConvE scores tokens alike with and without repeating the subject image.
+"""
+
+import copy
+import torch
+
+from model.link_prediction_models import ConvE
+
+def conve(dropout=0.):
+    args = {'embedding_dim': 40, 'embedding_shape1': 5, 'kernel_size': '(3, 3)', 'filter_channels': 32,
+            'stride': 1, 'padding': 0, 'use_bias': True, 'input_drop': dropout, 'hidden_drop': dropout,
+            'feat_drop': dropout, 'load_path': 'None'}
+    torch.manual_seed(0)
+    model = ConvE(args)
+    # non trivial batch norm parameters and statistics
+    for bn in [model.bn0, model.bn1, model.bn2]:
+        bn.weight.data.uniform_(0.5, 1.5)
+        bn.bias.data.uniform_(-0.5, 0.5)
+        bn.running_mean.uniform_(-0.5, 0.5)
+        bn.running_var.uniform_(0.5, 1.5)
+    return model
+
+def inputs(batch_size=3, num_tokens=7, dim=40):
+    torch.manual_seed(1)
+    return (torch.randn(batch_size, 1, dim, requires_grad=True), torch.randn(batch_size, num_tokens, dim, requires_grad=True),
+            torch.randn(batch_size, 1, dim, requires_grad=True))
+
+def test_eval_scores_match():
+    model = conve().eval()
+    e1, rel, e2 = inputs()
+    with torch.no_grad():
+        expected = model.repeated_subject_forward(e1, rel, e2)
+        torch.testing.assert_close(model.shared_subject_forward(e1, rel, e2), expected, atol=1e-5, rtol=1e-4)
+        # skipped tokens score 0
+        token_mask = torch.rand(rel.shape[:2]) < 0.6
+        scores = model(e1, rel, e2, token_mask)
+    torch.testing.assert_close(scores[token_mask], expected[token_mask], atol=1e-5, rtol=1e-4)
+    assert scores[~token_mask].abs().max() == 0
+
+def test_train_gradients_match():
+    repeated, shared = conve().train(), conve().train()
+    results = []
+    for model, forward in [(repeated, repeated.repeated_subject_forward), (shared, shared.forward)]:
+        e1, rel, e2 = inputs()
+        scores = forward(e1, rel, e2)
+        (scores ** 2).mean().backward()
+        grads = dict((name, p.grad) for name, p in model.named_parameters())
+        grads.update(e1=e1.grad, rel=rel.grad, e2=e2.grad)
+        results.append((scores, grads))
+    torch.testing.assert_close(results[1][0], results[0][0], atol=1e-4, rtol=1e-4)
+    for name, grad in results[0][1].items():
+        torch.testing.assert_close(results[1][1][name], grad, atol=1e-4, rtol=1e-3, msg=name)
+    # batch norm statistics are updated alike
+    for name, buffer in repeated.named_buffers():
+        torch.testing.assert_close(dict(shared.named_buffers())[name], buffer, atol=1e-5, rtol=1e-4)
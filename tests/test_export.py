@@ -0,0 +1,52 @@
+"""
+ExportableRNN, eager and exported, against the eager RelationModel.
+"""
+
+import os
+import numpy as np
+import pytest
+import torch
+
+from conftest import DATA_DIR, tiny_opt
+from data.loader import DataLoader
+from export import export_onnx, export_torchscript, flat_inputs
+from model.rnn import RelationModel, ExportableRNN
+
+ATOL = 1e-5
+
+def build(vocab, bidirectional):
+    torch.manual_seed(0)
+    opt = tiny_opt(vocab, bidirectional_encoding=bidirectional, encoding_dim=16 if bidirectional else 8)
+    model = RelationModel(opt)
+    # non trivial weights
+    for p in model.model.parameters():
+        p.data.normal_(0, 0.3)
+    model.model.eval()
+    # batches of different sizes and lengths
+    data_batch = DataLoader(os.path.join(DATA_DIR, 'dev.json'), 6, opt, vocab, evaluation=True)
+    return model, ExportableRNN(model.model).eval(), data_batch
+
+def check_parity(model, run, data_batch):
+    with torch.no_grad():
+        for batch in data_batch:
+            _, expected = model.infer(batch, unsort=False)
+            np.testing.assert_allclose(run(flat_inputs(batch)), expected, atol=ATOL)
+
+@pytest.mark.parametrize('bidirectional', [False, True])
+def test_eager_parity(vocab, bidirectional):
+    model, module, data_batch = build(vocab, bidirectional)
+    check_parity(model, lambda inputs: module(*inputs).numpy(), data_batch)
+
+@pytest.mark.parametrize('bidirectional', [False, True])
+def test_torchscript_parity(tmp_path, vocab, bidirectional):
+    model, module, data_batch = build(vocab, bidirectional)
+    run = export_torchscript(module, flat_inputs(data_batch[0]), str(tmp_path / 'model.ts'))
+    check_parity(model, run, data_batch)
+
+@pytest.mark.parametrize('bidirectional', [False, True])
+def test_onnx_parity(tmp_path, vocab, bidirectional):
+    pytest.importorskip('onnx')
+    pytest.importorskip('onnxruntime')
+    model, module, data_batch = build(vocab, bidirectional)
+    run = export_onnx(module, flat_inputs(data_batch[0]), str(tmp_path / 'model.onnx'))
+    check_parity(model, run, data_batch)
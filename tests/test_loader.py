@@ -0,0 +1,46 @@
+"""
+Shard batches between distributed ranks.
+"""
+
+import os
+import json
+import numpy as np
+import torch
+
+from conftest import DATA_DIR, tiny_opt
+from data.loader import DataLoader
+from model.rnn import RelationModel
+
+DEV_FILE = os.path.join(DATA_DIR, 'dev.json')
+
+def test_uneven_shards(vocab):
+    with open(DEV_FILE) as infile:
+        num_examples = len(json.load(infile))
+    batch_size, world_size = 3, 2
+    loaders = []
+    for rank in range(world_size):
+        # ranks shuffle alike under the same seed
+        np.random.seed(0)
+        loaders.append(DataLoader(DEV_FILE, batch_size, tiny_opt(vocab, rank=rank, world_size=world_size), vocab))
+    # full batches split into 2 examples for rank 0 and a single one for rank 1
+    assert len(loaders[0]) == len(loaders[1]) == int(np.ceil(num_examples / batch_size))
+    assert all(len(batch) == 1 for batch in loaders[1].data)
+    assert loaders[0].num_examples + loaders[1].num_examples == num_examples
+    assert loaders[0].num_examples > loaders[1].num_examples
+    for loader in loaders:
+        assert loader.num_examples == sum(len(batch) for batch in loader.data)
+        assert np.array_equal(loader.gold_ids(), loader.dataset.relations[np.concatenate(loader.data)])
+    assert len(set(np.concatenate(loaders[0].data)) & set(np.concatenate(loaders[1].data))) == 0
+
+    # the single example shards train
+    torch.manual_seed(0)
+    model = RelationModel(tiny_opt(vocab))
+    for batch in loaders[1]:
+        assert np.isfinite(model.update(batch))
+
+def test_rank_without_examples(vocab):
+    # batches of one example cannot be shared by two ranks, so both get none
+    loader = DataLoader(DEV_FILE, 1, tiny_opt(vocab, rank=1, world_size=2), vocab)
+    assert len(loader) == 0
+    assert loader.num_examples == 0
+    assert len(loader.gold_ids()) == 0
@@ -0,0 +1,33 @@
+"""
+Round trip a dynamically quantized checkpoint through RelationModel.save, load and infer.
+"""
+
+import os
+import numpy as np
+import torch
+
+from conftest import DATA_DIR, tiny_opt
+from data.loader import DataLoader
+from model.rnn import RelationModel
+from utils import torch_utils
+
+def test_quantized_checkpoint_round_trip(tmp_path, vocab):
+    torch.manual_seed(0)
+    opt = tiny_opt(vocab)
+    data_batch = DataLoader(os.path.join(DATA_DIR, 'dev.json'), opt['batch_size'], opt, vocab, evaluation=True)
+
+    model = RelationModel(opt)
+    model.quantize()
+    model_file = str(tmp_path / 'quantized_model.pt')
+    model.save(model_file, epoch=None)
+
+    loaded_opt = torch_utils.load_config(model_file)
+    assert loaded_opt['quantized']
+    loaded = RelationModel(loaded_opt)
+    loaded.load(model_file)
+    for batch in data_batch:
+        preds, probs = model.infer(batch)
+        loaded_preds, loaded_probs = loaded.infer(batch)
+        assert np.array_equal(preds, loaded_preds)
+        np.testing.assert_allclose(probs, loaded_probs, atol=1e-6)
+        np.testing.assert_allclose(probs.sum(1), 1., atol=1e-5)
@@ -0,0 +1,25 @@
+"""
+Train and infer PositionAwareRNN on edge case batches.
+"""
+
+import os
+import numpy as np
+import torch
+
+from conftest import DATA_DIR, tiny_opt
+from data.loader import DataLoader
+from model.rnn import RelationModel
+
+def test_one_example_batch(vocab):
+    # token budget batching and sharding can leave a single example in a batch
+    torch.manual_seed(0)
+    opt = tiny_opt(vocab)
+    data_batch = DataLoader(os.path.join(DATA_DIR, 'dev.json'), 1, opt, vocab, evaluation=False)
+    batch = data_batch[0]
+    assert len(batch['sentence_lengths']) == 1
+
+    model = RelationModel(opt)
+    loss = model.update(batch)
+    assert np.isfinite(loss)
+    preds, probs = model.infer(batch)
+    assert len(preds) == 1 and probs.shape == (1, opt['num_class'])
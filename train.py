@@ -10,15 +10,14 @@ import random
 import argparse
 from shutil import copyfile
 import torch
-import pickle
-import yaml
 import torch.nn as nn
 import torch.optim as optim
 
-from data.loader import DataLoader
+from data.loader import DataLoader, StreamingDataLoader
 from model.rnn import RelationModel
-from utils import scorer, constant, helper
-from utils.vocab import Vocab
+from utils import scorer, constant, helper, torch_utils
+from utils.config import default_config_path, load_model_config, parse_overrides
+from utils.vocab import Vocab, vocab_file as vocab_path
 from collections import defaultdict
 from configs.dict_with_attributes import AttributeDict
 
@@ -26,57 +25,17 @@ from configs.dict_with_attributes import AttributeDict
 def str2bool(v):
     return v.lower() in ('true')
 
-def add_fact_checking_params(cfg_dict):
-    fact_checking_config = os.path.join(cwd, 'configs', 'fact_checking_configs.yaml')
-    with open(fact_checking_config, 'r') as file:
-        fact_checking_config_dict = yaml.load(file)
-    fact_checking_model = cfg_dict['fact_checking_model']
-    params = fact_checking_config_dict[fact_checking_model]
-    params['name'] = fact_checking_model
-    return params
-
-def add_reg_params(cfg_dict):
-    if cfg_dict['reg_params'] != 'None':
-        reg_config = os.path.join(cwd, 'configs', 'regularization_config.yaml')
-        with open(reg_config, 'r') as file:
-            reg_config = yaml.load(file)
-            reg_type = cfg_dict['reg_params']
-            cfg_dict['reg_params'] = reg_config[reg_type]
-            cfg_dict['reg_params'].update(add_fact_checking_params(reg_config[reg_type]))
-            cfg_dict['reg_params']['type'] = reg_type
-            if cfg_dict['reg_params']['load_path'] == 'None':
-                cfg_dict['reg_params']['embedding_dim'] = cfg_dict['encoding_dim']
-            else:
-                cfg_dict['reg_params']['embedding_dim'] = 200
-    else:
-        cfg_dict['reg_params'] = None
-
-def add_encoding_config(cfg_dict):
-    if cfg_dict['encoding_type'] == 'BiLSTM':
-        cfg_dict['encoding_dim'] = cfg_dict['hidden_dim'] * 2
-        cfg_dict['bidirectional_encoding'] = True
-    elif cfg_dict['encoding_type'] == 'LSTM':
-        cfg_dict['encoding_dim'] = cfg_dict['hidden_dim']
-        cfg_dict['bidirectional_encoding'] = False
 
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', type=str, default='', help='Model config yaml; chosen by the working directory by default.')
+parser.add_argument('--set', type=str, nargs='*', default=[], metavar='KEY=VALUE',
+                    help='Override config values, e.g. --set seed=17 id=02 lr=0.5')
+args = parser.parse_args()
 
-cwd = os.getcwd()
-on_server = 'Desktop' not in cwd
-config_path = os.path.join(cwd, 'configs', f'model_config{"_server" if on_server else ""}.yaml')
+config_path = args.config if len(args.config) > 0 else default_config_path()
 # config_path = '/Users/georgestoica/Desktop/Research/tacred-exploration/configs/model_config.yaml'
 # config_path = '/zfsauton3/home/gis/research/tacred-exploration/configs/model_config_server.yaml'
-with open(config_path, 'r') as file:
-    cfg_dict = yaml.load(file)
-
-add_encoding_config(cfg_dict)
-if cfg_dict['fact_checking_attn']:
-    cfg_dict['fact_checker_params'] = add_fact_checking_params(cfg_dict)
-    if cfg_dict['fact_checker_params']['load_path'] == 'None':
-        cfg_dict['fact_checker_params']['embedding_dim'] = cfg_dict['encoding_dim']
-    else:
-        cfg_dict['fact_checker_params']['embedding_dim'] = 200
-
-add_reg_params(cfg_dict)
+cfg_dict = load_model_config(config_path, parse_overrides(args.set))
 
 print(cfg_dict)
 opt = cfg_dict#AttributeDict(cfg_dict)
@@ -90,15 +49,25 @@ if opt['cpu']:
 elif opt['cuda']:
     torch.cuda.manual_seed(opt['seed'])
 
+# distributed data parallel training when launched with torchrun, e.g.
+# torchrun --nproc_per_node 4 train.py. Only rank 0 evaluates, checkpoints and logs.
+rank, world_size = torch_utils.init_distributed(opt.get('dist_backend', 'gloo'))
+opt['rank'] = rank
+opt['world_size'] = world_size
+is_main = rank == 0
+if world_size > 1 and opt['cuda']:
+    torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+
 # opt = vars(args)
 opt['num_class'] = len(constant.LABEL_TO_ID)
 
 # load vocab
-vocab_file = opt['vocab_dir'] + '/vocab.pkl'
+vocab_file = vocab_path(opt['vocab_dir'])
 vocab = Vocab(vocab_file, load=True)
 opt['vocab_size'] = vocab.size
 emb_file = opt['vocab_dir'] + '/embedding.npy'
-emb_matrix = np.load(emb_file)
+# memory-map, the model copies rows straight into its embedding weights
+emb_matrix = np.load(emb_file, mmap_mode='r')
 assert emb_matrix.shape[0] == vocab.size - 2
 assert emb_matrix.shape[1] == opt['emb_dim']
 
@@ -107,9 +76,15 @@ opt['obj_idxs'] = vocab.obj_idxs
 
 # load data
 print("Loading data from {} with batch size {}...".format(opt['data_dir'], opt['batch_size']))
-train_batch = DataLoader(opt['data_dir'] + '/train.json', opt['batch_size'], opt, vocab, evaluation=False)
-dev_batch = DataLoader(opt['data_dir'] + '/dev.json', opt['batch_size'], opt, vocab, evaluation=True)
-test_batch = DataLoader(opt['data_dir'] + '/test.json', opt['batch_size'], opt, vocab, evaluation=True)
+if opt.get('streaming', False):
+    # streamed batches have no index to sample them by
+    assert opt.get('train_eval_sample', 1.) >= 1., "train_eval_sample < 1 is not supported with streaming."
+    train_batch = StreamingDataLoader(opt['data_dir'] + '/train.json', opt['batch_size'], opt, vocab, evaluation=False)
+else:
+    train_batch = DataLoader(opt['data_dir'] + '/train.json', opt['batch_size'], opt, vocab, evaluation=False)
+if is_main:
+    dev_batch = DataLoader(opt['data_dir'] + '/dev.json', opt['batch_size'], opt, vocab, evaluation=True)
+    test_batch = DataLoader(opt['data_dir'] + '/test.json', opt['batch_size'], opt, vocab, evaluation=True)
 
 model_id = opt['id'] if len(opt['id']) > 1 else '0' + opt['id']
 model_save_dir = os.path.join(opt['save_dir'], model_id)
@@ -117,22 +92,26 @@ opt['model_save_dir'] = model_save_dir
 helper.ensure_dir(model_save_dir, verbose=True)
 
 # save config
-helper.save_config(opt, model_save_dir + '/config.json', verbose=True)
-vocab.save(model_save_dir + '/vocab.pkl')
-file_logger = helper.FileLogger(model_save_dir + '/' + opt['log'], header="# epoch\ttrain_loss\tdev_loss\tdev_f1")
+if is_main:
+    helper.save_config(opt, model_save_dir + '/config.json', verbose=True)
+    vocab.save(model_save_dir + '/vocab.txt')
+    file_logger = helper.FileLogger(model_save_dir + '/' + opt['log'], header="# epoch\ttrain_loss\tdev_loss\tdev_f1")
 
 
 test_save_dir = os.path.join(opt['test_save_dir'], opt['id'])
 os.makedirs(test_save_dir, exist_ok=True)
-test_save_file = os.path.join(test_save_dir, 'test_records.pkl')
+test_save_file = os.path.join(test_save_dir, 'test_records.npy')
 
 # print model info
 helper.print_config(opt)
 
 # model
 model = RelationModel(opt, emb_matrix=emb_matrix)
+del emb_matrix
+if world_size > 1:
+    # all ranks start from the weights of rank 0, but draw different dropout masks
+    torch.manual_seed(opt['seed'] + rank)
 
-id2label = dict([(v,k) for k,v in constant.LABEL_TO_ID.items()])
 dev_f1_history = []
 current_lr = opt['lr']
 
@@ -142,105 +121,193 @@ format_str = '{}: step {}/{} (epoch {}/{}), loss = {:.6f} ({:.3f} sec/batch), lr
 max_steps = len(train_batch) * opt['num_epoch']
 best_dev_metrics = defaultdict(lambda: -np.inf)
 test_metrics_at_best_dev = defaultdict(lambda: -np.inf)
-
-# start training
-for epoch in range(1, opt['num_epoch']+1):
-    train_loss = 0
-    for i, batch in enumerate(train_batch):
-    # for i in range(0):
-        start_time = time.time()
-        global_step += 1
-        loss = model.update(batch)
-        train_loss += loss
-        if global_step % opt['log_step'] == 0:
-            duration = time.time() - start_time
-            print(format_str.format(datetime.now(), global_step, max_steps, epoch,\
-                    opt['num_epoch'], loss, duration, current_lr))
-
-    print("Evaluating on train set...")
-    predictions = []
-    train_eval_loss = 0
-    for i, batch in enumerate(train_batch):
-    # for i, _ in enumerate([]):
-        preds, _, loss = model.predict(batch)
-        predictions += preds
-        train_eval_loss += loss
-    predictions = [id2label[p] for p in predictions]
-    train_p, train_r, train_f1 = scorer.score(train_batch.gold(), predictions)
-
-    train_loss = train_loss / train_batch.num_examples * opt['batch_size']  # avg loss per batch
-    train_eval_loss = train_eval_loss / train_batch.num_examples * opt['batch_size']
-    print("epoch {}: train_loss = {:.6f}, dev_loss = {:.6f}, dev_f1 = {:.4f}".format(epoch,
-                                                                                     train_loss,
-                                                                                     train_eval_loss, train_f1))
-    file_logger.log("{}\t{:.6f}\t{:.6f}\t{:.4f}".format(epoch, train_loss, train_eval_loss, train_f1))
+# evaluation cadence: every eval_every_steps steps if set, otherwise every eval_every_epochs epochs
+eval_every_steps = opt.get('eval_every_steps', 0)
+eval_every_epochs = opt.get('eval_every_epochs', 1)
+patience = opt.get('patience', 0)
+test_at_best_only = opt.get('test_at_best_only', False)
+evals_since_best = 0
+
+def evaluate(data_batch):
+    """ Returns precision, recall, F1, average loss per batch and probabilities on data_batch. """
+    all_probs = []
+    loss = 0
+    for batch in data_batch:
+        _, probs, batch_loss = model.infer(batch, with_loss=True)
+        all_probs.append(probs)
+        loss += batch_loss
+    all_probs = np.concatenate(all_probs)
+    predictions = np.argmax(all_probs, axis=1)
+    p, r, f1 = scorer.score_ids(data_batch.gold_ids(), predictions, constant.ID_TO_LABEL)
+    loss = loss / data_batch.num_examples * opt['batch_size'] # avg loss per batch
+    return p, r, f1, loss, all_probs
+
+def save_test_records(test_probs):
+    print("Saving test info...")
+    helper.save_probs(test_probs, test_save_file)
+
+def run_evaluation(epoch, train_loss, model_file, keep_checkpoint):
+    """ Evaluate on dev (and test), checkpoint and decay lr. Returns True if training should stop. """
+    global best_dev_metrics, test_metrics_at_best_dev, current_lr, dev_f1_history, evals_since_best
 
     # eval on dev
     print("Evaluating on dev set...")
-    predictions = []
-    dev_loss = 0
-    for i, batch in enumerate(dev_batch):
-        preds, _, loss = model.predict(batch)
-        predictions += preds
-        dev_loss += loss
-    predictions = [id2label[p] for p in predictions]
-    dev_p, dev_r, dev_f1 = scorer.score(dev_batch.gold(), predictions)
-    
-    train_loss = train_loss / train_batch.num_examples * opt['batch_size'] # avg loss per batch
-    dev_loss = dev_loss / dev_batch.num_examples * opt['batch_size']
+    dev_p, dev_r, dev_f1, dev_loss, _ = evaluate(dev_batch)
     print("epoch {}: train_loss = {:.6f}, dev_loss = {:.6f}, dev_f1 = {:.4f}".format(epoch,\
             train_loss, dev_loss, dev_f1))
     file_logger.log("{}\t{:.6f}\t{:.6f}\t{:.4f}".format(epoch, train_loss, dev_loss, dev_f1))
     current_dev_metrics = {'f1': dev_f1, 'precision': dev_p, 'recall': dev_r}
+    is_best = best_dev_metrics['f1'] < current_dev_metrics['f1']
 
-    print("Evaluating on test set...")
-    predictions = []
-    test_loss = 0
-    test_preds = []
-    for i, batch in enumerate(test_batch):
-        preds, probs, loss = model.predict(batch)
-        predictions += preds
-        test_loss += loss
-        test_preds += probs
-    predictions = [id2label[p] for p in predictions]
-    test_p, test_r, test_f1 = scorer.score(test_batch.gold(), predictions)
-    test_metrics_at_current_dev = {'f1': test_f1, 'precision': test_p, 'recall': test_r}
-
-    if best_dev_metrics['f1'] < current_dev_metrics['f1']:
+    if not test_at_best_only:
+        print("Evaluating on test set...")
+        test_p, test_r, test_f1, test_loss, test_probs = evaluate(test_batch)
+        test_metrics_at_current_dev = {'f1': test_f1, 'precision': test_p, 'recall': test_r}
+        print("epoch {}: test_loss = {:.6f}, test_f1 = {:.4f}".format(epoch, test_loss, test_f1))
+        file_logger.log("{}\t{:.6f}\t{:.6f}\t{:.4f}".format(epoch, train_loss, test_loss, test_f1))
+
+    if is_best:
         best_dev_metrics = current_dev_metrics
-        test_metrics_at_best_dev = test_metrics_at_current_dev
-        print("Saving test info...")
-        with open(test_save_file, 'wb') as outfile:
-            pickle.dump(test_preds, outfile)
+        evals_since_best = 0
+        if not test_at_best_only:
+            test_metrics_at_best_dev = test_metrics_at_current_dev
+            save_test_records(test_probs)
+    else:
+        evals_since_best += 1
 
     print("Best Dev Metrics | F1: {} | Precision: {} | Recall: {}".format(
         best_dev_metrics['f1'], best_dev_metrics['precision'], best_dev_metrics['recall']
     ))
-    print("Test Metrics at Best Dev | F1: {} | Precision: {} | Recall: {}".format(
-        test_metrics_at_best_dev['f1'], test_metrics_at_best_dev['precision'], test_metrics_at_best_dev['recall']
-    ))
-
-    train_loss = train_loss / train_batch.num_examples * opt['batch_size']  # avg loss per batch
-    print("epoch {}: test_loss = {:.6f}, test_f1 = {:.4f}".format(epoch, test_loss, test_f1))
-    file_logger.log("{}\t{:.6f}\t{:.6f}\t{:.4f}".format(epoch, train_loss, test_loss, test_f1))
+    if not test_at_best_only:
+        print("Test Metrics at Best Dev | F1: {} | Precision: {} | Recall: {}".format(
+            test_metrics_at_best_dev['f1'], test_metrics_at_best_dev['precision'], test_metrics_at_best_dev['recall']
+        ))
 
     # save
-    model_file = model_save_dir + '/checkpoint_epoch_{}.pt'.format(epoch)
     model.save(model_file, epoch)
-    if epoch == 1 or dev_f1 > max(dev_f1_history):
+    if is_best:
         copyfile(model_file, model_save_dir + '/best_model.pt')
         print("new best model saved.")
-    if epoch % opt['save_epoch'] != 0:
+    if not keep_checkpoint:
         os.remove(model_file)
-    
+
     # lr schedule
-    if len(dev_f1_history) > 10 and dev_f1 <= dev_f1_history[-1] and \
+    if len(dev_f1_history) > opt.get('lr_decay_after', 10) and dev_f1 <= dev_f1_history[-1] and \
             opt['optim'] in ['sgd', 'adagrad']:
         current_lr *= opt['lr_decay']
         model.update_lr(current_lr)
 
     dev_f1_history += [dev_f1]
     print("")
+    if patience > 0 and evals_since_best >= patience:
+        print("Dev F1 has not improved for {} evaluations, stopping early.".format(patience))
+        return True
+    return False
+
+def run_synced_evaluation(epoch, train_loss, model_file, keep_checkpoint):
+    """ Evaluate on rank 0, and share its lr schedule and early stopping decisions with the other ranks. """
+    global current_lr
+    stop_training = run_evaluation(epoch, train_loss, model_file, keep_checkpoint) if is_main else None
+    if world_size > 1:
+        stop_training, lr = torch_utils.broadcast_object((stop_training, current_lr))
+        if lr != current_lr:
+            current_lr = lr
+            model.update_lr(current_lr)
+    return stop_training
 
-print("Training ended with {} epochs.".format(epoch))
+# start training
+stop_training = False
+for epoch in range(1, opt['num_epoch']+1):
+    train_loss = 0
+    num_steps = 0
+    # training metrics are accumulated online from the logits of each update
+    train_confusion = scorer.ConfusionMatrix(constant.ID_TO_LABEL)
+    for i, batch in enumerate(train_batch):
+    # for i in range(0):
+        start_time = time.time()
+        global_step += 1
+        num_steps += 1
+        loss, preds, gold = model.update(batch, with_predictions=True)
+        train_loss += loss
+        train_confusion.update(gold, preds)
+        if is_main and global_step % opt['log_step'] == 0:
+            duration = time.time() - start_time
+            print(format_str.format(datetime.now(), global_step, max_steps, epoch,\
+                    opt['num_epoch'], loss, duration, current_lr))
+        if eval_every_steps > 0 and global_step % eval_every_steps == 0:
+            model_file = model_save_dir + '/checkpoint_step_{}.pt'.format(global_step)
+            stop_training = run_synced_evaluation(epoch, train_loss / num_steps, model_file, keep_checkpoint=False)
+            if stop_training:
+                break
+    if stop_training:
+        break
+
+    # avg loss per optimizer step, as batches differ in size under token_budget and bucket batching
+    train_loss = train_loss / num_steps
+    if world_size > 1:
+        # averaged over ranks, with the predictions of all ranks
+        train_loss = float(torch_utils.all_reduce_sum(train_loss)) / world_size
+        train_confusion.counts = torch_utils.all_reduce_sum(train_confusion.counts)
+    train_p, train_r, train_f1 = train_confusion.score()
+    # nan in the log unless a train evaluation pass runs
+    train_eval_loss = float('nan')
+    print("epoch {}: train_loss = {:.6f}, online train_f1 = {:.4f}".format(epoch, train_loss, train_f1))
+
+    # optional full evaluation pass over (a sample of) the train set. In distributed training
+    # every rank evaluates its own shard, so that all ranks keep drawing the same batch seeds.
+    if opt.get('train_eval_every', 0) > 0 and epoch % opt['train_eval_every'] == 0:
+        print("Evaluating on train set...")
+        if opt.get('train_eval_sample', 1.) < 1.:
+            num_eval_batches = max(1, int(len(train_batch) * opt['train_eval_sample']))
+            # a generator of its own, so that sampling leaves the global ones to training
+            sample_rng = np.random.RandomState((opt['seed'] + epoch) % 2 ** 32)
+            sample_keys = np.sort(sample_rng.choice(len(train_batch), num_eval_batches, replace=False))
+            sample_seed = sample_rng.randint(2 ** 31)
+            eval_batches = (train_batch.get_batch(int(key), sample_seed) for key in sample_keys)
+        else:
+            num_eval_batches = len(train_batch)
+            eval_batches = iter(train_batch)
+        eval_confusion = scorer.ConfusionMatrix(constant.ID_TO_LABEL)
+        train_eval_loss = 0
+        for batch in eval_batches:
+            # compare in the sorted batch order, so gold labels come from the batch itself
+            gold = batch['base'][7].numpy()
+            preds, _, loss = model.infer(batch, unsort=False, with_loss=True)
+            eval_confusion.update(gold, preds)
+            train_eval_loss += loss
+        train_eval_loss = train_eval_loss / num_eval_batches
+        if world_size > 1:
+            eval_confusion.counts = torch_utils.all_reduce_sum(eval_confusion.counts)
+            train_eval_loss = float(torch_utils.all_reduce_sum(train_eval_loss)) / world_size
+        train_p, train_r, train_f1 = eval_confusion.score()
+        print("epoch {}: train_loss = {:.6f}, train_eval_loss = {:.6f}, train_f1 = {:.4f}".format(epoch,
+                                                                                                   train_loss,
+                                                                                                   train_eval_loss, train_f1))
+    if is_main:
+        file_logger.log("{}\t{:.6f}\t{:.6f}\t{:.4f}".format(epoch, train_loss, train_eval_loss, train_f1))
+
+    if eval_every_steps <= 0 and epoch % eval_every_epochs == 0:
+        model_file = model_save_dir + '/checkpoint_epoch_{}.pt'.format(epoch)
+        stop_training = run_synced_evaluation(epoch, train_loss, model_file,
+                                              keep_checkpoint=epoch % opt['save_epoch'] == 0)
+        if stop_training:
+            break
+
+if is_main and test_at_best_only and os.path.exists(model_save_dir + '/best_model.pt'):
+    print("Evaluating best model on test set...")
+    model.load(model_save_dir + '/best_model.pt')
+    test_p, test_r, test_f1, test_loss, test_probs = evaluate(test_batch)
+    test_metrics_at_best_dev = {'f1': test_f1, 'precision': test_p, 'recall': test_r}
+    save_test_records(test_probs)
+    print("Test Metrics at Best Dev | F1: {} | Precision: {} | Recall: {}".format(
+        test_metrics_at_best_dev['f1'], test_metrics_at_best_dev['precision'], test_metrics_at_best_dev['recall']
+    ))
 
+# best metrics of the run, collected by launch.py
+if is_main:
+    summary = {'id': opt['id'], 'seed': opt['seed'], 'epochs': epoch, 'minutes': (time.time() - global_start_time) / 60,
+               'best_dev': dict(best_dev_metrics), 'test_at_best_dev': dict(test_metrics_at_best_dev)}
+    helper.save_config(summary, model_save_dir + '/summary.json', verbose=False)
+if world_size > 1:
+    torch.distributed.destroy_process_group()
+print("Training ended with {} epochs.".format(epoch))
@@ -0,0 +1,84 @@
+"""
+Assemble the training config from the yaml files in configs/.
+"""
+
+import os
+import yaml
+
+
+def default_config_path(cwd=None):
+    """ The model config yaml to use, depending on whether we are running on the server. """
+    cwd = os.getcwd() if cwd is None else cwd
+    on_server = 'Desktop' not in cwd
+    return os.path.join(cwd, 'configs', f'model_config{"_server" if on_server else ""}.yaml')
+
+def add_fact_checking_params(cfg_dict, config_dir):
+    fact_checking_config = os.path.join(config_dir, 'fact_checking_configs.yaml')
+    with open(fact_checking_config, 'r') as file:
+        fact_checking_config_dict = yaml.safe_load(file)
+    fact_checking_model = cfg_dict['fact_checking_model']
+    params = fact_checking_config_dict[fact_checking_model]
+    params['name'] = fact_checking_model
+    return params
+
+def add_reg_params(cfg_dict, config_dir):
+    if cfg_dict['reg_params'] != 'None':
+        reg_config = os.path.join(config_dir, 'regularization_config.yaml')
+        with open(reg_config, 'r') as file:
+            reg_config = yaml.safe_load(file)
+            reg_type = cfg_dict['reg_params']
+            cfg_dict['reg_params'] = reg_config[reg_type]
+            cfg_dict['reg_params'].update(add_fact_checking_params(reg_config[reg_type], config_dir))
+            cfg_dict['reg_params']['type'] = reg_type
+            if cfg_dict['reg_params']['load_path'] == 'None':
+                cfg_dict['reg_params']['embedding_dim'] = cfg_dict['encoding_dim']
+            else:
+                cfg_dict['reg_params']['embedding_dim'] = 200
+    else:
+        cfg_dict['reg_params'] = None
+
+def add_encoding_config(cfg_dict):
+    if cfg_dict['encoding_type'] == 'BiLSTM':
+        cfg_dict['encoding_dim'] = cfg_dict['hidden_dim'] * 2
+        cfg_dict['bidirectional_encoding'] = True
+    elif cfg_dict['encoding_type'] == 'LSTM':
+        cfg_dict['encoding_dim'] = cfg_dict['hidden_dim']
+        cfg_dict['bidirectional_encoding'] = False
+
+def parse_overrides(pairs):
+    """ Parse KEY=VALUE strings into a dict of raw string values. """
+    overrides = {}
+    for pair in pairs:
+        key, sep, value = pair.partition('=')
+        assert len(sep) > 0, "Config overrides must look like KEY=VALUE, got {}.".format(pair)
+        overrides[key.strip()] = value.strip()
+    return overrides
+
+def apply_overrides(cfg_dict, overrides):
+    """ Override config values with raw strings, parsed as yaml unless the value they replace is a string. """
+    for key, value in overrides.items():
+        if not isinstance(cfg_dict.get(key), str):
+            value = yaml.safe_load(value)
+        cfg_dict[key] = value
+
+def load_model_config(config_path, overrides=None):
+    """
+    Load a model config yaml, apply overrides (KEY: raw string value) and fill in the
+    encoding, fact checking and regularization params.
+    """
+    config_dir = os.path.dirname(config_path)
+    with open(config_path, 'r') as file:
+        cfg_dict = yaml.safe_load(file)
+    if overrides:
+        apply_overrides(cfg_dict, overrides)
+
+    add_encoding_config(cfg_dict)
+    if cfg_dict['fact_checking_attn']:
+        cfg_dict['fact_checker_params'] = add_fact_checking_params(cfg_dict, config_dir)
+        if cfg_dict['fact_checker_params']['load_path'] == 'None':
+            cfg_dict['fact_checker_params']['embedding_dim'] = cfg_dict['encoding_dim']
+        else:
+            cfg_dict['fact_checker_params']['embedding_dim'] = 200
+
+    add_reg_params(cfg_dict, config_dir)
+    return cfg_dict
@@ -4,7 +4,9 @@ Helper functions.
 
 import os
 import json
+import pickle
 import argparse
+import numpy as np
 
 ### IO
 def check_dir(d):
@@ -38,6 +40,50 @@ def load_config(path, verbose=True):
         print("Config loaded from file {}".format(path))
     return config
 
+def iter_json(filename, chunk_size=1 << 20):
+    """
+    Iterate over the records of a JSON array or JSON-lines file, decoding them one at
+    a time from a bounded buffer instead of loading the whole file.
+    """
+    decoder = json.JSONDecoder()
+    with open(filename, encoding='utf8') as infile:
+        buffer, pos = '', 0
+        while True:
+            # skip whitespace and the array brackets and commas between records
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,[]':
+                pos += 1
+            if pos == len(buffer):
+                buffer, pos = infile.read(chunk_size), 0
+                if not buffer:
+                    return
+                continue
+            try:
+                record, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # the record is cut off at the end of the buffer
+                chunk = infile.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+            yield record
+
+def save_probs(probs, filename, dtype='float32'):
+    """ Save an (examples x classes) probability array as .npy, or as a pickled list for .pkl files. """
+    probs = np.asarray(probs, dtype=np.float32)
+    if filename.endswith('.pkl'):
+        with open(filename, 'wb') as outfile:
+            pickle.dump(probs.tolist(), outfile)
+    else:
+        np.save(filename, probs.astype(dtype))
+
+def load_probs(filename, mmap_mode='r'):
+    """ Load probabilities saved by save_probs, memory-mapping .npy files. """
+    if filename.endswith('.pkl'):
+        with open(filename, 'rb') as infile:
+            return np.asarray(pickle.load(infile), dtype=np.float32)
+    return np.load(filename, mmap_mode=mmap_mode)
+
 def print_config(config):
     info = "Running with the following configs:\n"
     for k,v in config.items():
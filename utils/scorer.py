@@ -6,7 +6,7 @@ Score the predictions with gold labels, using precision, recall and F1 metrics.
 
 import argparse
 import sys
-from collections import Counter
+import numpy as np
 
 NO_RELATION = "no_relation"
 
@@ -17,83 +17,121 @@ def parse_arguments():
     args = parser.parse_args()
     return args
 
+def safe_divide(numerator, denominator, default):
+    """ Elementwise numerator / denominator, or default where denominator is 0. """
+    numerator, denominator = np.broadcast_arrays(np.asarray(numerator, dtype=np.float64),
+                                                 np.asarray(denominator, dtype=np.float64))
+    quotient = np.full(numerator.shape, default, dtype=np.float64)
+    np.divide(numerator, denominator, out=quotient, where=denominator > 0)
+    return quotient
+
+def f1_score(prec, recall):
+    return safe_divide(2.0 * prec * recall, prec + recall, 0.0)
+
+class ConfusionMatrix(object):
+    """
+    Counts of (gold, predicted) label id pairs, where labels[i] is the name of id i. Counts
+    can be accumulated over batches with update, and combined across shards or processes
+    with merge (or +, or by summing the counts arrays). The negative label (no_relation) is
+    never counted as correct or guessed, as in the official TACRED scorer.
+    """
+    def __init__(self, labels, counts=None):
+        self.labels = list(labels)
+        self.num_labels = len(self.labels)
+        self.negative_id = self.labels.index(NO_RELATION) if NO_RELATION in self.labels else -1
+        if counts is None:
+            counts = np.zeros((self.num_labels, self.num_labels), dtype=np.int64)
+        assert counts.shape == (self.num_labels, self.num_labels), "Counts must be num_labels x num_labels."
+        self.counts = counts
+
+    def update(self, gold, predicted):
+        """ Add integer arrays of gold and predicted label ids. """
+        gold = np.asarray(gold, dtype=np.int64)
+        predicted = np.asarray(predicted, dtype=np.int64)
+        assert gold.shape == predicted.shape, "Gold and predicted labels must have the same shape."
+        pairs = gold.ravel() * self.num_labels + predicted.ravel()
+        self.counts += np.bincount(pairs, minlength=self.num_labels ** 2).reshape(self.num_labels, self.num_labels)
+        return self
+
+    def merge(self, other):
+        assert self.labels == other.labels, "Cannot merge confusion matrices over different labels."
+        self.counts += other.counts
+        return self
+
+    def __add__(self, other):
+        return ConfusionMatrix(self.labels, self.counts.copy()).merge(other)
+
+    def relation_counts(self):
+        """ Per label correct, guessed and gold counts, which are 0 for the negative label. """
+        correct = np.diag(self.counts).copy()
+        guessed = self.counts.sum(0)
+        gold = self.counts.sum(1)
+        if self.negative_id >= 0:
+            correct[self.negative_id] = guessed[self.negative_id] = gold[self.negative_id] = 0
+        return correct, guessed, gold
+
+    def micro(self):
+        """ Micro averaged precision, recall and F1. """
+        correct, guessed, gold = self.relation_counts()
+        prec = float(safe_divide(correct.sum(), guessed.sum(), 1.0))
+        recall = float(safe_divide(correct.sum(), gold.sum(), 0.0))
+        return prec, recall, float(f1_score(prec, recall))
+
+    def per_relation(self):
+        """ Per label precision, recall, F1 and gold counts, as arrays indexed by label id. """
+        correct, guessed, gold = self.relation_counts()
+        prec = safe_divide(correct, guessed, 1.0)
+        recall = safe_divide(correct, gold, 0.0)
+        return prec, recall, f1_score(prec, recall), gold
+
+    def macro(self):
+        """ Precision, recall and F1 averaged over the relations that occur in gold. """
+        prec, recall, f1, gold = self.per_relation()
+        present = gold > 0
+        if not present.any():
+            return 1.0, 0.0, 0.0
+        return float(prec[present].mean()), float(recall[present].mean()), float(f1[present].mean())
+
+    def score(self, verbose=False):
+        """ Print the scores (per relation as well if verbose) and return micro precision, recall and F1. """
+        if verbose:
+            print("Per-relation statistics:")
+            prec, recall, f1, gold = self.per_relation()
+            relations = sorted((self.labels[i], i) for i in np.nonzero(gold)[0])
+            longest_relation = max([len(relation) for relation, _ in relations] + [0])
+            for relation, i in relations:
+                sys.stdout.write(("{:<" + str(longest_relation) + "}").format(relation))
+                for name, value in [('P', prec[i]), ('R', recall[i]), ('F1', f1[i])]:
+                    sys.stdout.write("  {}: ".format(name))
+                    if value < 0.1: sys.stdout.write(' ')
+                    if value < 1.0: sys.stdout.write(' ')
+                    sys.stdout.write("{:.2%}".format(value))
+                sys.stdout.write("  #: %d" % gold[i])
+                sys.stdout.write("\n")
+            print("")
+
+            macro_prec, macro_recall, macro_f1 = self.macro()
+            print("Final Score:")
+            print( "Precision (macro): {:.3%}".format(macro_prec) )
+            print( "   Recall (macro): {:.3%}".format(macro_recall) )
+            print( "       F1 (macro): {:.3%}".format(macro_f1) )
+        prec_micro, recall_micro, f1_micro = self.micro()
+        print( "Precision (micro): {:.3%}".format(prec_micro) )
+        print( "   Recall (micro): {:.3%}".format(recall_micro) )
+        print( "       F1 (micro): {:.3%}".format(f1_micro) )
+        return prec_micro, recall_micro, f1_micro
+
+def score_ids(gold, predicted, labels, verbose=False):
+    """ Score integer arrays of gold and predicted label ids, where labels[i] is the name of id i. """
+    return ConfusionMatrix(labels).update(gold, predicted).score(verbose)
+
 def score(key, prediction, verbose=False):
-    correct_by_relation = Counter()
-    guessed_by_relation = Counter()
-    gold_by_relation    = Counter()
-
-    # Loop over the data to compute a score
-    for row in range(len(key)):
-        gold = key[row]
-        guess = prediction[row]
-         
-        if gold == NO_RELATION and guess == NO_RELATION:
-            pass
-        elif gold == NO_RELATION and guess != NO_RELATION:
-            guessed_by_relation[guess] += 1
-        elif gold != NO_RELATION and guess == NO_RELATION:
-            gold_by_relation[gold] += 1
-        elif gold != NO_RELATION and guess != NO_RELATION:
-            guessed_by_relation[guess] += 1
-            gold_by_relation[gold] += 1
-            if gold == guess:
-                correct_by_relation[guess] += 1
-
-    # Print verbose information
-    if verbose:
-        print("Per-relation statistics:")
-        relations = gold_by_relation.keys()
-        longest_relation = 0
-        for relation in sorted(relations):
-            longest_relation = max(len(relation), longest_relation)
-        for relation in sorted(relations):
-            # (compute the score)
-            correct = correct_by_relation[relation]
-            guessed = guessed_by_relation[relation]
-            gold    = gold_by_relation[relation]
-            prec = 1.0
-            if guessed > 0:
-                prec = float(correct) / float(guessed)
-            recall = 0.0
-            if gold > 0:
-                recall = float(correct) / float(gold)
-            f1 = 0.0
-            if prec + recall > 0:
-                f1 = 2.0 * prec * recall / (prec + recall)
-            # (print the score)
-            sys.stdout.write(("{:<" + str(longest_relation) + "}").format(relation))
-            sys.stdout.write("  P: ")
-            if prec < 0.1: sys.stdout.write(' ')
-            if prec < 1.0: sys.stdout.write(' ')
-            sys.stdout.write("{:.2%}".format(prec))
-            sys.stdout.write("  R: ")
-            if recall < 0.1: sys.stdout.write(' ')
-            if recall < 1.0: sys.stdout.write(' ')
-            sys.stdout.write("{:.2%}".format(recall))
-            sys.stdout.write("  F1: ")
-            if f1 < 0.1: sys.stdout.write(' ')
-            if f1 < 1.0: sys.stdout.write(' ')
-            sys.stdout.write("{:.2%}".format(f1))
-            sys.stdout.write("  #: %d" % gold)
-            sys.stdout.write("\n")
-        print("")
-
-    # Print the aggregate score
-    if verbose:
-        print("Final Score:")
-    prec_micro = 1.0
-    if sum(guessed_by_relation.values()) > 0:
-        prec_micro   = float(sum(correct_by_relation.values())) / float(sum(guessed_by_relation.values()))
-    recall_micro = 0.0
-    if sum(gold_by_relation.values()) > 0:
-        recall_micro = float(sum(correct_by_relation.values())) / float(sum(gold_by_relation.values()))
-    f1_micro = 0.0
-    if prec_micro + recall_micro > 0.0:
-        f1_micro = 2.0 * prec_micro * recall_micro / (prec_micro + recall_micro)
-    print( "Precision (micro): {:.3%}".format(prec_micro) )
-    print( "   Recall (micro): {:.3%}".format(recall_micro) )
-    print( "       F1 (micro): {:.3%}".format(f1_micro) )
-    return prec_micro, recall_micro, f1_micro
+    """ Score lists of gold and predicted relation names. """
+    labels = sorted(set(key) | set(prediction) | set([NO_RELATION]))
+    label_to_id = dict((label, i) for i, label in enumerate(labels))
+    gold = np.array([label_to_id[label] for label in key], dtype=np.int64)
+    predicted = np.array([label_to_id[label] for label in prediction], dtype=np.int64)
+    return score_ids(gold, predicted, labels, verbose)
 
 if __name__ == "__main__":
     # Parse the arguments from stdin
@@ -2,7 +2,10 @@
 Utility functions for torch.
 """
 
+import os
+import numpy as np
 import torch
+import torch.distributed as dist
 from torch import nn, optim
 from torch.optim import Optimizer
 
@@ -119,6 +122,12 @@ def set_cuda(var, cuda):
         return var.cuda()
     return var
 
+def unsort_rows(x, orig_idx):
+    """ Undo a sort of the rows of x, where orig_idx[i] is the original position of row i. """
+    unsorted = torch.empty_like(x)
+    unsorted[orig_idx.to(x.device)] = x
+    return unsorted
+
 def keep_partial_grad(grad, topk):
     """
     Keep only the topk rows of grads.
@@ -127,6 +136,39 @@ def keep_partial_grad(grad, topk):
     grad.data[topk:].zero_()
     return grad
 
+### distributed
+def init_distributed(backend='gloo'):
+    """
+    Join the process group described by the torchrun environment variables (RANK,
+    WORLD_SIZE, MASTER_ADDR, MASTER_PORT). Returns the rank and world size, which are
+    0 and 1 when not launched by torchrun.
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return 0, 1
+    dist.init_process_group(backend=backend)
+    return dist.get_rank(), dist.get_world_size()
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+def collective_device():
+    """ The device to run collectives on: nccl only communicates cuda tensors. """
+    if dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+def all_reduce_sum(array):
+    """ Sum a number or numpy array over all processes. """
+    tensor = torch.from_numpy(np.array(array)).to(collective_device())
+    dist.all_reduce(tensor)
+    return tensor.cpu().numpy()
+
+def broadcast_object(obj, src=0):
+    """ Send a picklable object from rank src to all processes. """
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src, device=collective_device())
+    return objects[0]
+
 ### model IO
 def save(model, optimizer, opt, filename):
     params = {
@@ -141,9 +183,10 @@ def save(model, optimizer, opt, filename):
 
 def load(model, optimizer, filename):
     try:
-        dump = torch.load(filename)
+        dump = torch.load(filename, weights_only=False)
     except BaseException:
         print("[ Fail: model loading failed. ]")
+        raise
     if model is not None:
         model.load_state_dict(dump['model'])
     if optimizer is not None:
@@ -152,9 +195,11 @@ def load(model, optimizer, filename):
     return model, optimizer, opt
 
 def load_config(filename):
+    # checkpoints hold the config dict, and quantized ones packed params, so they are not weights only
     try:
-        dump = torch.load(filename)
+        dump = torch.load(filename, map_location='cpu', weights_only=False)
     except BaseException:
         print("[ Fail: model loading failed. ]")
+        raise
     return dump['config']
 
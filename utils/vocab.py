@@ -4,7 +4,9 @@ A class for basic vocab operations.
 
 from __future__ import print_function
 import os
+import json
 import random
+import multiprocessing
 import numpy as np
 import pickle
 
@@ -13,20 +15,143 @@ from utils import constant
 random.seed(1234)
 np.random.seed(1234)
 
-def build_embedding(wv_file, vocab, wv_dim):
+def build_embedding(glove_vectors, vocab, wv_dim, chunk_size=100000):
+    """ Build the embedding matrix of vocab from a word to vector mapping (see load_glove). """
     vocab_size = len(vocab)
-    emb = np.random.uniform(-1, 1, (vocab_size, wv_dim))
+    # fill in chunks to avoid a full size float64 temporary
+    emb = np.empty((vocab_size, wv_dim), dtype=np.float32)
+    for start in range(0, vocab_size, chunk_size):
+        end = min(start + chunk_size, vocab_size)
+        emb[start:end] = np.random.uniform(-1, 1, (end - start, wv_dim))
     emb[constant.PAD_ID] = 0 # <pad> should be all 0 (using broadcast)
 
-    w2id = {w: i for i, w in enumerate(vocab)}
-    with open(wv_file, encoding="utf8") as f:
-        for line in f:
-            elems = line.split()
-            token = ''.join(elems[0:-wv_dim])
-            if token in w2id:
-                emb[w2id[token]] = [float(v) for v in elems[-wv_dim:]]
+    for i, w in enumerate(vocab):
+        if w in glove_vectors:
+            emb[i] = glove_vectors[w]
     return emb
 
+def glove_cache_files(wv_file, cache_dir=None):
+    """ Word list and raw float32 matrix files of the binary cache of wv_file, next to it by default. """
+    base = os.path.splitext(wv_file)[0]
+    if cache_dir is not None:
+        base = os.path.join(cache_dir, os.path.basename(base))
+    return base + '.words.txt', base + '.vectors.f32'
+
+def glove_cache_header(wv_file, wv_dim):
+    """ What the binary cache of wv_file was built from, stored as the first line of its word list. """
+    stat = os.stat(wv_file)
+    return {'source_size': stat.st_size, 'source_mtime': stat.st_mtime, 'wv_dim': wv_dim}
+
+def load_glove(wv_file, wv_dim, words, num_workers=1, use_cache=True, cache_dir=None):
+    """
+    Load the GloVe vectors of words in a single pass, as a dict from word to float32
+    vector. With use_cache, the whole file is first converted into a binary cache
+    (see glove_cache_files) that is memory-mapped by every later call. The cache holds
+    every word of the file, and is rebuilt when wv_file or wv_dim change.
+    """
+    if use_cache:
+        cache = read_glove_cache(wv_file, wv_dim, cache_dir)
+        if cache is None:
+            print("building binary cache of {}...".format(wv_file))
+            try:
+                build_glove_cache(wv_file, wv_dim, num_workers, cache_dir)
+                cache = read_glove_cache(wv_file, wv_dim, cache_dir)
+            except OSError as e:
+                print("[ Warning: cannot write the binary cache ({}), reading {} directly. ]".format(e, wv_file))
+    if not use_cache or cache is None:
+        glove_vectors = dict()
+        for chunk_words, chunk_vectors in parse_glove(wv_file, wv_dim, words, num_workers):
+            glove_vectors.update(zip(chunk_words, chunk_vectors))
+        return glove_vectors
+    glove_words, vectors = cache
+    # later duplicates override earlier ones, like in the text file
+    return dict((w, vectors[i]) for i, w in enumerate(glove_words) if w in words)
+
+def read_glove_cache(wv_file, wv_dim, cache_dir=None):
+    """ Words and memory-mapped vectors of the binary cache of wv_file, or None if it is missing or stale. """
+    words_file, vectors_file = glove_cache_files(wv_file, cache_dir)
+    if not (os.path.exists(words_file) and os.path.exists(vectors_file)):
+        return None
+    with open(words_file, encoding='utf8') as infile:
+        lines = infile.read().split('\n')
+    try:
+        header = json.loads(lines[0])
+    except ValueError:
+        return None
+    glove_words = lines[1:]
+    if header != glove_cache_header(wv_file, wv_dim) or \
+            os.path.getsize(vectors_file) != len(glove_words) * wv_dim * 4:
+        return None
+    if len(glove_words) == 0:
+        return glove_words, np.zeros((0, wv_dim), dtype=np.float32)
+    return glove_words, np.memmap(vectors_file, dtype=np.float32, mode='r', shape=(len(glove_words), wv_dim))
+
+def build_glove_cache(wv_file, wv_dim, num_workers=1, cache_dir=None):
+    words_file, vectors_file = glove_cache_files(wv_file, cache_dir)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    header = glove_cache_header(wv_file, wv_dim)
+    glove_words = []
+    tmp_file = '{}.{}.tmp'.format(vectors_file, os.getpid())
+    with open(tmp_file, 'wb') as outfile:
+        for chunk_words, chunk_vectors in parse_glove(wv_file, wv_dim, None, num_workers):
+            glove_words += chunk_words
+            chunk_vectors.tofile(outfile)
+    os.replace(tmp_file, vectors_file)
+    # the header is written last, so an interrupted build is never taken as valid
+    save_vocab([json.dumps(header)] + glove_words, words_file)
+
+def parse_glove(wv_file, wv_dim, words=None, num_workers=1, chunk_bytes=1 << 26):
+    """
+    Parse a GloVe text file in line aligned chunks of about chunk_bytes, in parallel
+    if num_workers > 1. Yields (words, float32 vectors) per chunk in file order, only
+    keeping words in words if given.
+    """
+    jobs = [(wv_file, start, end, wv_dim, words) for start, end in chunk_offsets(wv_file, chunk_bytes)]
+    if num_workers <= 1:
+        for job in jobs:
+            yield parse_glove_chunk(job)
+        return
+    with multiprocessing.Pool(num_workers) as pool:
+        for result in pool.imap(parse_glove_chunk, jobs):
+            yield result
+
+def chunk_offsets(filename, chunk_bytes):
+    """ (start, end) byte offsets of chunks of filename that begin and end on line boundaries. """
+    size = os.path.getsize(filename)
+    offsets = [0]
+    with open(filename, 'rb') as infile:
+        while offsets[-1] < size:
+            infile.seek(min(offsets[-1] + chunk_bytes, size))
+            infile.readline()
+            offsets.append(min(infile.tell(), size))
+    return list(zip(offsets[:-1], offsets[1:]))
+
+def parse_glove_chunk(job):
+    wv_file, start, end, wv_dim, words = job
+    with open(wv_file, 'rb') as infile:
+        infile.seek(start)
+        text = infile.read(end - start).decode('utf8')
+    # same line breaks as iterating over a file opened in text mode
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    chunk_words, chunk_vectors = [], []
+    for line in lines:
+        elems = line.split()
+        if len(elems) == 0:
+            continue
+        token = ''.join(elems[0:-wv_dim])
+        if words is None or token in words:
+            chunk_words.append(token)
+            chunk_vectors.append(elems[-wv_dim:])
+    chunk_vectors = np.array(chunk_vectors, dtype=np.float32).reshape(-1, wv_dim)
+    return chunk_words, chunk_vectors
+
+def save_vocab(words, filename):
+    """ Write a vocab list as one word per line. """
+    assert not any('\n' in w for w in words), "Words cannot contain newlines."
+    with open(filename, 'w', encoding='utf8') as outfile:
+        outfile.write('\n'.join(words))
+
 def load_glove_vocab(file, wv_dim):
     """
     Load all words from glove.
@@ -50,8 +175,16 @@ def normalize_glove(token):
         token = mapping[token]
     return token
 
+def vocab_file(dirname):
+    """ Vocab file in dirname, preferring the text format over the legacy pickle. """
+    filename = os.path.join(dirname, 'vocab.txt')
+    if os.path.exists(filename):
+        return filename
+    return os.path.join(dirname, 'vocab.pkl')
+
 class Vocab(object):
     def __init__(self, filename, load=False, word_counter=None, threshold=0):
+        self.filename = filename
         if load:
             assert os.path.exists(filename), "Vocab file does not exist at " + filename
             # load from file and ignore all other params
@@ -85,9 +218,14 @@ class Vocab(object):
             print("Vocab size {} saved to file {}".format(self.size, filename))
 
     def load(self, filename):
-        with open(filename, 'rb') as infile:
-            id2word = pickle.load(infile)
-            word2id = dict([(id2word[idx], idx) for idx in range(len(id2word))])
+        if filename.endswith('.txt'):
+            # one word per line
+            with open(filename, encoding='utf8') as infile:
+                id2word = infile.read().split('\n')
+        else:
+            with open(filename, 'rb') as infile:
+                id2word = pickle.load(infile)
+        word2id = dict(zip(id2word, range(len(id2word))))
         return id2word, word2id
 
     def save(self, filename):
@@ -95,8 +233,11 @@ class Vocab(object):
         if os.path.exists(filename):
             print("Overwriting old vocab file at " + filename)
             os.remove(filename)
-        with open(filename, 'wb') as outfile:
-            pickle.dump(self.id2word, outfile)
+        if filename.endswith('.txt'):
+            save_vocab(self.id2word, filename)
+        else:
+            with open(filename, 'wb') as outfile:
+                pickle.dump(self.id2word, outfile)
         return
 
     def map(self, token_list):